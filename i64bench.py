@@ -0,0 +1,177 @@
+"""
+Times i64edit.py operations on synthetic databases of several sizes, written by i64gen.py.
+
+Every run opens a fresh copy of the database in a forked process, so the peak memory
+reported is that of one repair job. The results can be saved as json and compared
+against an earlier run to catch slowdowns.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from i64edit import ID0, FileHandler, IDBFile
+from i64gen import generate
+
+PHASES = ('open', 'list', 'check', 'movefunc', 'insert', 'save')
+
+
+def run_phases(path):
+    """ runs the operations on `path` in this process, returns seconds for each phase and peak rss in bytes """
+    times = {}
+    state = {}
+
+    def timed(name, fn):
+        t0 = time.perf_counter()
+        fn()
+        times[name] = time.perf_counter() - t0
+
+    def open_db():
+        state['fh'] = FileHandler(path)
+        state['id0'] = ID0(IDBFile(state['fh']))
+        state['id0'].fdl
+
+    def check():
+        fdl.checktree()
+
+    def movefunc():
+        # the first function of the first dir having any goes to another dir
+        src = next(d for d in fdl.dirs.values() if d.funcs)
+        dst = next(i for i in fdl.dirs if i != src.i)
+        fdl.movefunc((src.funcs[0], dst))
+        fdl.apply()
+
+    def insert():
+        fdl.insert((max(fdl.dirs) + 1, 0))
+        fdl.apply()
+
+    def save():
+        state['id0'].save()
+        state['fh'].close()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        timed('open', open_db)
+        fdl = state['id0'].fdl
+        timed('list', fdl.print)
+        timed('check', check)
+        timed('movefunc', movefunc)
+        timed('insert', insert)
+        timed('save', save)
+    # ru_maxrss is in KiB on linux
+    return times, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(path, workdir, repeat):
+    """ best time of each phase and highest peak rss over `repeat` runs, each on a new copy """
+    best = {}
+    rss = 0
+    work = os.path.join(workdir, 'work.i64')
+    ctx = multiprocessing.get_context('fork')
+    for _ in range(repeat):
+        shutil.copyfile(path, work)
+        with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+            times, peak = pool.submit(run_phases, work).result()
+        for name, t in times.items():
+            best[name] = min(best.get(name, t), t)
+        rss = max(rss, peak)
+    os.unlink(work)
+    return best, rss
+
+
+def parse_scales(text):
+    """ 'dirs:funcs,dirs:funcs' -> list of tuples """
+    scales = []
+    for item in text.split(','):
+        dirs, funcs = item.split(':')
+        scales.append((int(dirs), int(funcs)))
+    return scales
+
+
+def bench(scales, workdir, repeat=3, schema=75, compress=False):
+    results = []
+    for ndirs, nfuncs in scales:
+        name = f'bench_{ndirs}_{nfuncs}_{schema}{"_z" if compress else ""}.i64'
+        path = os.path.join(workdir, name)
+        if not os.path.exists(path):
+            t0 = time.perf_counter()
+            generate(path, ndirs, nfuncs, schema, compress)
+            print(f'generated {name} in {time.perf_counter() - t0:.1f}s')
+        times, rss = measure(path, workdir, repeat)
+        results.append(dict(name=name, dirs=ndirs, funcs=nfuncs, size=os.path.getsize(path), times=times, rss=rss))
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f'{"dirs":>6} {"funcs":>8} {"size":>10} ' + ' '.join(f'{p:>9}' for p in PHASES) + f' {"rss":>8}')
+    for r in results:
+        line = f'{r["dirs"]:6} {r["funcs"]:8} {r["size"]:10} '
+        line += ' '.join(f'{r["times"][p] * 1000:7.1f}ms' for p in PHASES)
+        line += f' {r["rss"] / 0x100000:6.1f}MB'
+        print(line)
+        old = baseline.get(r['name']) if baseline else None
+        if old:
+            print(f'{"":26} ' + ' '.join(f'{r["times"][p] / old["times"][p]:8.2f}x' for p in PHASES) +
+                  f' {r["rss"] / old["rss"]:7.2f}x')
+
+
+def slowdowns(results, baseline, threshold):
+    """ phases slower than `threshold` times the baseline """
+    found = []
+    for r in results:
+        old = baseline.get(r['name'])
+        if not old:
+            continue
+        for p in PHASES:
+            if r['times'][p] > old['times'][p] * threshold:
+                found.append(f'{r["name"]} {p}: {old["times"][p] * 1000:.1f}ms -> {r["times"][p] * 1000:.1f}ms')
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Times i64edit.py on synthetic databases',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog="""
+Examples:
+
+  i64bench --scales 10:1000,300:30000 --save before.json
+  i64bench --scales 10:1000,300:30000 --compare before.json
+  i64bench --compress --schema 76 --workdir /tmp/i64bench
+""")
+    parser.add_argument('--scales', default='10:1000,300:30000,3000:300000',
+                        help='comma separated dirs:funcs sizes to run (default: %(default)s)')
+    parser.add_argument('--schema', type=int, choices=(75, 76), default=75, help='folder data layout')
+    parser.add_argument('--compress', action='store_true', help='zlib compressed sections')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the best time is kept', metavar='n')
+    parser.add_argument('--workdir', metavar='dir',
+                        help='keep generated databases here and reuse them (default: temporary)')
+    parser.add_argument('--save', metavar='filename', help='write results as json')
+    parser.add_argument('--compare', metavar='filename', help='compare with results saved earlier')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='with --compare, exit code 1 if a phase is this many times slower (default: %(default)s)')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {r['name']: r for r in json.load(f)}
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(workdir, exist_ok=True)
+        results = bench(parse_scales(args.scales), workdir, args.repeat, args.schema, args.compress)
+
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if baseline:
+        found = slowdowns(results, baseline, args.threshold)
+        for line in found:
+            print(f'slower: {line}')
+        sys.exit(1 if found else 0)
@@ -1,14 +1,76 @@
 import argparse
 import binascii
+import bisect
+import contextlib
+import copy
+import cProfile
+import csv
+import ctypes
+import ctypes.util
+import glob
 import io
+import json
+import mmap
+import multiprocessing
+import os
+import shlex
+import socket
+import socketserver
 import struct
 import sys
+import tempfile
+import time
+import traceback
 import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import cached_property
 from shutil import copyfile
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 def auto_int(x):
     return int(x, 0)
 
+class Stats:
+    """ counters and wall clock seconds per phase of a run, printed as json by --stats """
+    def __init__(self):
+        self.counters = {}
+        self.seconds = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - t0
+
+    def as_dict(self):
+        return {
+            'counters': dict(sorted(self.counters.items())),
+            'seconds': {k: round(v, 6) for k, v in sorted(self.seconds.items())},
+        }
+
+    def write(self, filename):
+        """ json to `filename`, or to stdout for '-' """
+        text = json.dumps(self.as_dict(), indent=1)
+        if filename == '-':
+            print(text)
+        else:
+            with open(filename, 'w') as f:
+                f.write(text + '\n')
+
+STATS = Stats()
+
 def hexdump(data):
     if data is None:
         return
@@ -44,11 +106,11 @@ def pack(fmt, data, start=0):
     return struct.unpack(fmt, data[start:start + count])
 
 
-def binary_search(a, k):
-    first, last = 0, len(a)
+def binary_search(page, k):
+    first, last = 0, page.entrycount
     while first < last:
         mid = (first + last) >> 1
-        if k < a[mid].key:
+        if k < page.getkey(mid):
             last = mid
         else:
             first = mid + 1
@@ -57,6 +119,252 @@ def binary_search(a, k):
 def remove_duplicates(items):
     return list(dict.fromkeys(items))
 
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+def prefix_end(prefix):
+    """ smallest key above all keys starting with `prefix`, None if there is none """
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+def spooled(mem_limit):
+    """ temporary file kept in memory up to `mem_limit` bytes like the output of inflate, None for no limit """
+    # SpooledTemporaryFile never rolls over with max_size 0
+    return tempfile.SpooledTemporaryFile(0 if mem_limit is None else max(mem_limit, 1))
+
+def inflate(fh, size, mem_limit=None, chunksize=0x100000):
+    """
+    Decompresses `size` bytes of zlib stream read from `fh` chunk by chunk.
+    Output is kept in memory until it grows over `mem_limit` bytes,
+    after that it goes to a temporary file which is then memory-mapped.
+    Returns the file object and decompressed size.
+    """
+    d = zlib.decompressobj(15)
+    out = io.BytesIO()
+    spilled = False
+    left = size
+    while left:
+        buf = fh.read(min(chunksize, left))
+        if not buf:
+            raise Exception("compressed section truncated")
+        left -= len(buf)
+        while buf:
+            out.write(d.decompress(buf, chunksize))
+            buf = d.unconsumed_tail
+            if not spilled and mem_limit is not None and out.tell() > mem_limit:
+                spill = tempfile.TemporaryFile()
+                spill.write(out.getbuffer())
+                out = spill
+                spilled = True
+    out.write(d.flush())
+    if not d.eof:
+        raise Exception("compressed section truncated, zlib stream does not end")
+    size = out.tell()
+    STATS.count('bytes_inflated', size)
+
+    if not spilled:
+        out.seek(0)
+        return out, size
+    out.flush()
+    return MappedFile(out), size
+
+def deflate_block(data, dictionary, last, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary) if dictionary else \
+        zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+
+def deflate(fs, out, blocksize=0x20000, workers=None, level=-1):
+    """
+    Compresses everything read from `fs` into a single zlib stream written to `out`,
+    returns its size. Like pigz, blocks are deflated in parallel, each one primed
+    with the last 32 KiB of the previous block and ended with a full flush.
+    """
+    workers = workers or os.cpu_count() or 1
+    out.write(b'\x78\x9c')
+    size = 2
+    adler = 1
+    with ThreadPoolExecutor(workers) as pool:
+        pending = []
+        dictionary = b''
+        data = bytes(fs.read(blocksize))
+        while data:
+            following = bytes(fs.read(blocksize))
+            adler = zlib.adler32(data, adler)
+            pending.append(pool.submit(deflate_block, data, dictionary, not following, level))
+            dictionary = data[-0x8000:]
+            data = following
+            while len(pending) > workers * 2 or pending and not data:
+                chunk = pending.pop(0).result()
+                out.write(chunk)
+                size += len(chunk)
+        if size == 2:
+            chunk = zlib.compressobj(level, zlib.DEFLATED, -15).flush()
+            out.write(chunk)
+            size += len(chunk)
+    out.write(struct.pack('>L', adler))
+    STATS.count('bytes_deflated', size + 4)
+    return size + 4
+
+# below this many values the numpy setup costs more than it saves
+NUMPY_MIN_VALUES = 2048
+
+def unpack_wide(data, o):
+    """ one packed 32 bit value of any width, returns it and the offset after it """
+    b = data[o]
+    if b < 0x80:
+        return b, o + 1
+    if b < 0xC0:
+        return (b & 0x3F) << 8 | data[o + 1], o + 2
+    if b < 0xE0:
+        return int.from_bytes(data[o:o + 4], 'big') & 0x1FFFFFFF, o + 4
+    if b == 0xFF:
+        return int.from_bytes(data[o + 1:o + 5], 'big'), o + 5
+    raise ValueError(f"invalid packed value at {o}")
+
+def unpack_deltas(data, o, count):
+    """
+    Decodes `count` 64 bit deltas, each stored as two packed 32 bit values,
+    starting at offset `o`. Returns array('Q') of running sums, wrapping at 64 bits
+    like the addresses do, and the offset after the last one.
+    """
+    if np is not None and count >= NUMPY_MIN_VALUES:
+        return unpack_deltas_np(data, o, count)
+    values = array('Q')
+    total = 0
+    try:
+        for _ in range(count):
+            b = data[o]
+            if b < 0x80:
+                lo = b
+                o += 1
+            elif b < 0xC0:
+                lo = (b & 0x3F) << 8 | data[o + 1]
+                o += 2
+            else:
+                lo, o = unpack_wide(data, o)
+            b = data[o]
+            if b == 0:
+                # high half is zero for all positive deltas below 4G
+                o += 1
+                total = (total + lo) & 0xFFFFFFFFFFFFFFFF
+            else:
+                hi, o = unpack_wide(data, o)
+                total = (total + (hi << 32 | lo)) & 0xFFFFFFFFFFFFFFFF
+            values.append(total)
+    except IndexError:
+        raise ValueError("packed data truncated") from None
+    if o > len(data):
+        raise ValueError("packed data truncated")
+    return values, o
+
+if np is not None:
+    # length of a packed value by its first byte, 0 = invalid
+    PACKED_LEN = np.zeros(256, np.intp)
+    PACKED_LEN[:0x80] = 1
+    PACKED_LEN[0x80:0xC0] = 2
+    PACKED_LEN[0xC0:0xE0] = 4
+    PACKED_LEN[0xFF] = 5
+
+def unpack_deltas_np(data, o, count, block=64):
+    """
+    Vectorized unpack_deltas. Where each value starts depends on all values before it:
+    a table of the position `block` values further on is built by pointer doubling,
+    block starts are chained through it, then the blocks are split in halves
+    with the intermediate tables until every value has its start.
+    """
+    buf = np.frombuffer(data, np.uint8, offset=o)
+    n = len(buf)
+    m = 2 * count
+    lens = PACKED_LEN[buf]
+    nxt = np.arange(n, dtype=np.int32) + lens.astype(np.int32)
+    nxt[lens == 0] = n
+    nxt = np.append(np.minimum(nxt, n), np.int32(n))
+    tables = [nxt]
+    while 1 << len(tables) < block:
+        tables.append(tables[-1][tables[-1]])
+    jump = tables[-1][tables[-1]]
+
+    pos = 0
+    starts = np.empty((m + block - 1) // block, np.int32)
+    for j in range(len(starts)):
+        starts[j] = pos
+        pos = jump[pos]
+    for t in reversed(tables):
+        starts = np.stack([starts, t[starts]], axis=1).ravel()
+    starts = starts[:m]
+    if starts[-1] >= n or not lens[starts].all():
+        raise ValueError("invalid or truncated packed data")
+    end = int(starts[-1] + lens[starts[-1]])
+    if end > n:
+        raise ValueError("packed data truncated")
+
+    # big endian dword at every byte offset, without copying
+    padded = np.append(buf, np.zeros(4, np.uint8))
+    dwords = np.ndarray(n + 1, '>u4', padded, strides=(1,))
+    w = dwords[starts].astype(np.uint32)
+    b0 = w >> 24
+    v = np.where(b0 < 0x80, b0, np.where(b0 < 0xC0, w >> 16 & 0x3FFF, w & 0x1FFFFFFF))
+    wide = b0 == 0xFF
+    v[wide] = dwords[starts[wide] + 1]
+    v = v.astype(np.uint64)
+    deltas = v[1::2] << np.uint64(32) | v[0::2]
+    values = array('Q')
+    values.frombytes(np.cumsum(deltas, dtype=np.uint64).tobytes())
+    return values, o + end
+
+def pack_deltas(values):
+    """ encodes differences between consecutive values, the first one as is,
+    as signed 64 bit numbers in two packed 32 bit halves """
+    if np is not None and len(values) >= NUMPY_MIN_VALUES:
+        return pack_deltas_np(values)
+    out = bytearray()
+    prev = 0
+    for val in values:
+        delta = val - prev
+        prev = val
+        if 0 <= delta < 0x80:
+            out += bytes((delta, 0))
+            continue
+        delta &= 0xFFFFFFFFFFFFFFFF
+        for v in (delta & 0xFFFFFFFF, delta >> 32):
+            if v < 0x80:
+                out.append(v)
+            elif v < 0x4000:
+                out += (v | 0x8000).to_bytes(2, 'big')
+            elif v < 0x20000000:
+                out += (v | 0xC0000000).to_bytes(4, 'big')
+            else:
+                out.append(0xFF)
+                out += v.to_bytes(4, 'big')
+    return bytes(out)
+
+def pack_deltas_np(values):
+    vals = np.array(values, np.uint64)
+    deltas = np.diff(vals, prepend=np.uint64(0))
+    v = np.empty(2 * len(deltas), np.uint64)
+    v[0::2] = deltas & np.uint64(0xFFFFFFFF)
+    v[1::2] = deltas >> np.uint64(32)
+    lens = np.where(v < 0x80, 1, np.where(v < 0x4000, 2, np.where(v < 0x20000000, 4, 5)))
+    pos = np.cumsum(lens) - lens
+    out = np.zeros(int(lens.sum()), np.uint8)
+
+    def put(sel, *parts):
+        for i, part in enumerate(parts):
+            out[pos[sel] + i] = part[sel] & 0xFF
+
+    put(lens == 1, v)
+    put(lens == 2, v >> 8 | 0x80, v)
+    put(lens == 4, v >> 24 | 0xC0, v >> 16, v >> 8, v)
+    put(lens == 5, v | 0xFF, v >> 24, v >> 16, v >> 8, v)
+    return out.tobytes()
+
 class IdaUnpacker:
     def __init__(self, data):
         self.data = data
@@ -78,6 +386,11 @@ class IdaUnpacker:
             return val
         return val - 0x10000000000000000
 
+    def next64signed_sums(self, count):
+        """ `count` signed 64 bit deltas at once, returns their running sums """
+        values, self.o = unpack_deltas(self.data, self.o, count)
+        return values
+
     def next32(self):
         if self.eof():
             return None
@@ -143,7 +456,7 @@ class IdaPacker:
         elif val < 0x20000000:
             # a 29 bit value:
             # 110x xxxx xxxx xxxx xxxx xxxx xxxx xxxx
-            val |= 0x80000000
+            val |= 0xC0000000
             b = struct.pack(">L", val)
         else:
             # a 32 bit value:
@@ -151,77 +464,54 @@ class IdaPacker:
             b = struct.pack(">BI", 0xFF, val)
         self.data += b
 
-class BytesReader:
-    def __init__(self, data):
-        self.data = data
-        self.pos = 0
-        self.coverage = [False] * len(data)
-
-    def tell(self):
-        return self.pos
-
-    def get_coverage(self):
-        ret = ''
-        state = -1
-        count = 0
-        for e in self.coverage:
-            if e != state:
-                if count:
-                    ret += f'{state}*{count}, '
-                state = e
-                count = 1
-            else:
-                count += 1
-        ret += f'{e}*{count}'
-        return ret
-
-    def read(self, count):
-        end = self.pos + count
-        if end > len(self.data):
-            raise Exception("read overrun")
-        ret = self.data[self.pos:end]
-        self.coverage[self.pos:end] = [True] * (end - self.pos)
-        self.pos = end
-        return ret
+    def push64signed_deltas(self, values):
+        """ differences between consecutive values, the first one as is """
+        self.data += pack_deltas(values)
 
-    def reads(self, fmt):
-        fmt = '=' + fmt
-        count = struct.calcsize(fmt)
-        data = self.read(count)
-        ret = struct.unpack(fmt, data)
-        if type(ret) == tuple and len(ret) == 1:
-            return ret[0]
-        return ret
+# set by --debug-coverage, BytesWriter then records the byte ranges it touches
+TRACK_COVERAGE = False
 
-    def seek(self, off):
-        self.pos = off
+class Coverage:
+    """ byte ranges touched in a buffer, as sorted and merged [start, end) intervals """
+    def __init__(self, size):
+        self.size = size
+        self.starts = []
+        self.ends = []
 
-    def modify(self, off, newbytes):
-        end = off + len(newbytes)
-        if end > len(self.data):
-            raise NotImplementedError("read overrun")
-        self.data[off:end] = newbytes
+    def add(self, start, end):
+        if start >= end:
+            return
+        # intervals overlapping or touching start..end are merged into one
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def __str__(self):
+        parts = []
+        pos = 0
+        for start, end in zip(self.starts, self.ends):
+            if start > pos:
+                parts.append(f'False*{start - pos}')
+            parts.append(f'True*{end - start}')
+            pos = end
+        if pos < self.size:
+            parts.append(f'False*{self.size - pos}')
+        return ', '.join(parts)
 
 class BytesWriter:
     def __init__(self, other):
         self.data = bytearray(other)
         self.pos = 0
-        self.coverage = [False] * len(self.data)
+        self.coverage = Coverage(len(self.data)) if TRACK_COVERAGE else None
 
     def get_coverage(self):
-        ret = ''
-        state = -1
-        count = 0
-        for e in self.coverage:
-            if e != state:
-                if count:
-                    ret += f'{state}*{count}, '
-                state = e
-                count = 1
-            else:
-                count += 1
-        ret += f'{e}*{count}'
-        return ret
+        if self.coverage is None:
+            return 'not tracked'
+        return str(self.coverage)
 
     def write(self, bin):
         start = self.pos
@@ -230,7 +520,8 @@ class BytesWriter:
             raise NotImplementedError("write overrun")
         self.data[start:end] = bin
         self.pos = end
-        self.coverage[start:end] = [True] * (end - start)
+        if self.coverage is not None:
+            self.coverage.add(start, end)
 
     def writes(self, fmt, *args):
         fmt = '=' + fmt
@@ -241,6 +532,7 @@ class BytesWriter:
 
 class FileHandler:
     def __init__(self, filename):
+        self.filename = filename
         self.f = open(filename, "r+b")
 
     def read(self, count):
@@ -271,11 +563,384 @@ class FileHandler:
     def tell(self):
         return self.f.tell()
 
+    def move(self, src, dst, count, bufsize=0x100000):
+        """ copies `count` bytes from `src` to a higher `dst` offset. Goes from the end
+        towards the start, so overlapping data is read before it is overwritten """
+        self.f.flush()
+        fd = self.f.fileno()
+        # source and destination of one copy_file_range call must not overlap, with a small
+        # shift that means many small calls, slower than copying through a buffer
+        use_copy_range = hasattr(os, 'copy_file_range') and dst - src >= bufsize
+        end = count
+        while end > 0:
+            n = min(bufsize, end)
+            start = end - n
+            done = 0
+            if use_copy_range:
+                try:
+                    while done < n:
+                        r = os.copy_file_range(fd, fd, n - done, src + start + done, dst + start + done)
+                        if r == 0:
+                            break
+                        done += r
+                except OSError:
+                    use_copy_range = False
+            if done < n:
+                self.f.seek(src + start + done)
+                data = self.f.read(n - done)
+                self.f.seek(dst + start + done)
+                self.f.write(data)
+            end = start
+        self.f.flush()
+
+    def crc32(self, offset, count, bufsize=0x100000):
+        """ crc32 of `count` bytes at `offset`. Reads through a file handle of its own,
+        so several threads can hash parts of the same file at once """
+        self.f.flush()
+        crc = 0
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            while count:
+                data = f.read(min(bufsize, count))
+                if not data:
+                    raise Exception("file truncated")
+                crc = zlib.crc32(data, crc)
+                count -= len(data)
+        return crc
+
     def close(self):
         self.f.close()
 
 
+class MappedFile:
+    """
+    Same interface as FileHandler, but reads return memoryview slices
+    of a read-only mapping of the whole file instead of copies.
+    Writes go through the file object, the mapping sees them.
+    """
+
+    def __init__(self, f, pos=0):
+        self.f = f
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        self.pos = pos
+
+    def read(self, count=-1):
+        if count < 0:
+            count = max(len(self.view) - self.pos, 0)
+        end = self.pos + count
+        if end <= len(self.view):
+            bs = self.view[self.pos:end]
+        else:
+            self.f.seek(self.pos)
+            bs = self.f.read(count)
+        self.pos = end
+        return bs
+
+    def reads(self, fmt):
+        fmt = '=' + fmt
+        i = struct.calcsize(fmt)
+        ret = struct.unpack(fmt, self.read(i))
+        if type(ret) == tuple and len(ret) == 1:
+            return ret[0]
+        return ret
+
+    def seek(self, off):
+        self.pos = off
+
+    def write(self, data):
+        self.f.seek(self.pos)
+        self.f.write(data)
+        self.f.flush()
+        self.pos += len(data)
+
+    def tell(self):
+        return self.pos
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint), ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p), ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong),
+    ]
+
+_libz = None
+
+def load_libz():
+    """ python's zlib module can't stop at deflate block boundaries,
+    so the index is built with the system zlib when there is one """
+    global _libz
+    if _libz is None:
+        _libz = False
+        name = ctypes.util.find_library('z') or ctypes.util.find_library('zlib1')
+        if name:
+            try:
+                z = ctypes.CDLL(name)
+                z.zlibVersion.restype = ctypes.c_char_p
+                z.inflateInit2_.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+                z.inflate.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int]
+                z.inflateEnd.argtypes = [ctypes.POINTER(ZStream)]
+                z.inflatePrime.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_int]
+                z.inflateSetDictionary.argtypes = [ctypes.POINTER(ZStream), ctypes.c_char_p, ctypes.c_uint]
+                _libz = z
+            except (OSError, AttributeError):
+                pass
+    return _libz
+
+
+class InflateIndex:
+    """
+    Checkpoints into a zlib stream, taken at deflate block boundaries
+    roughly every `span` bytes of output, same as zlib's examples/zran.c.
+    Each point is (outpos, inpos, bits, window): decompression can restart at
+    byte `inpos` (minus `bits` bits of the byte before it) with `window` as
+    dictionary and produces data starting at `outpos`.
+    """
+    MAGIC = b'i64edit idx1'
+    WINSIZE = 0x8000
+    CHUNK = 0x10000
+
+    def __init__(self, key, size, points):
+        self.key = key
+        self.size = size
+        self.points = points
+        self.outs = [p[0] for p in points]
+
+    @classmethod
+    def build(cls, fh, length, key, span=0x100000):
+        z = load_libz()
+        if not z:
+            return None
+        strm = ZStream()
+        if z.inflateInit2_(ctypes.byref(strm), 15, z.zlibVersion(), ctypes.sizeof(strm)) != 0:
+            raise Exception("inflateInit2 failed")
+        inbuf = ctypes.create_string_buffer(cls.CHUNK)
+        window = ctypes.create_string_buffer(cls.WINSIZE)
+        points = []
+        totin = totout = last = 0
+        ret = 0
+        try:
+            while ret != 1:  # Z_STREAM_END
+                data = fh.read(min(cls.CHUNK, length - totin))
+                if not data:
+                    raise Exception("compressed section truncated")
+                ctypes.memmove(inbuf, data, len(data))
+                strm.next_in = ctypes.addressof(inbuf)
+                strm.avail_in = len(data)
+                while True:
+                    if strm.avail_out == 0:
+                        strm.next_out = ctypes.addressof(window)
+                        strm.avail_out = cls.WINSIZE
+                    totin += strm.avail_in
+                    totout += strm.avail_out
+                    ret = z.inflate(ctypes.byref(strm), 5)  # Z_BLOCK
+                    totin -= strm.avail_in
+                    totout -= strm.avail_out
+                    if ret < 0 and ret != -5 or ret == 2:  # anything but Z_BUF_ERROR, or Z_NEED_DICT
+                        raise Exception(f"inflate failed ({ret})")
+                    if ret == 1:
+                        break
+                    # at the end of a block, which is not the last one
+                    if strm.data_type & 128 and not strm.data_type & 64 and (totout == 0 or totout - last > span):
+                        left = strm.avail_out
+                        win = window.raw
+                        points.append((totout, totin, strm.data_type & 7,
+                                       win[cls.WINSIZE - left:] + win[:cls.WINSIZE - left]))
+                        last = totout
+                    if strm.avail_in == 0:
+                        break
+        finally:
+            z.inflateEnd(ctypes.byref(strm))
+        return cls(key, totout, points)
+
+    @classmethod
+    def load(cls, path, key):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not data.startswith(cls.MAGIC):
+            return None
+        # a truncated or damaged index is stale, it is built again
+        try:
+            o = len(cls.MAGIC)
+            keylen, = struct.unpack_from('<H', data, o)
+            o += 2
+            if data[o:o + keylen] != key:
+                return None
+            o += keylen
+            size, count = struct.unpack_from('<QL', data, o)
+            o += 12
+            points = []
+            for _ in range(count):
+                outpos, inpos, bits, winlen = struct.unpack_from('<QQBL', data, o)
+                o += 21
+                window = zlib.decompress(data[o:o + winlen])
+                if len(window) != cls.WINSIZE or bits > 7:
+                    raise ValueError("bad checkpoint")
+                points.append((outpos, inpos, bits, window))
+                o += winlen
+            if o != len(data):
+                raise ValueError("trailing data")
+        except (struct.error, zlib.error, ValueError):
+            return None
+        return cls(key, size, points)
+
+    def save(self, path):
+        """ written to a temporary file first, so an interrupted run leaves the old index or none """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack('<H', len(self.key)) + self.key)
+            f.write(struct.pack('<QL', self.size, len(self.points)))
+            for outpos, inpos, bits, window in self.points:
+                window = zlib.compress(window)
+                f.write(struct.pack('<QQBL', outpos, inpos, bits, len(window)))
+                f.write(window)
+        os.replace(tmp, path)
+
+    @classmethod
+    def open(cls, path, fh, length, key):
+        """ loads index from sidecar file, or builds and stores it there """
+        index = cls.load(path, key)
+        if index is None:
+            start = fh.tell()
+            index = cls.build(fh, length, key)
+            fh.seek(start)
+            if index is not None:
+                try:
+                    index.save(path)
+                except OSError:
+                    pass
+        return index
+
+
+class IndexedFile:
+    """
+    Read-only file interface to data of a compressed section,
+    only the spans holding requested bytes are decompressed.
+    """
+
+    def __init__(self, fh, index: InflateIndex, maxspans=8):
+        self.fh = fh
+        self.start = fh.tell()
+        self.index = index
+        self.spans = OrderedDict()
+        self.maxspans = maxspans
+        self.pos = 0
+
+    def compressed(self, inpos):
+        """ yields compressed data from a checkpoint """
+        self.fh.seek(self.start + inpos)
+        while True:
+            data = self.fh.read(InflateIndex.CHUNK)
+            if not data:
+                return
+            yield data
+
+    def inflate_primed(self, inpos, bits, window, need):
+        """
+        Restarts in the middle of a byte. Shifting the input to a byte boundary
+        would misalign stored blocks, so the leftover bits are fed to the
+        system zlib with inflatePrime, like zran.c does.
+        """
+        z = load_libz()
+        strm = ZStream()
+        if z.inflateInit2_(ctypes.byref(strm), -15, z.zlibVersion(), ctypes.sizeof(strm)) != 0:
+            raise Exception("inflateInit2 failed")
+        try:
+            self.fh.seek(self.start + inpos - 1)
+            z.inflatePrime(ctypes.byref(strm), bits, self.fh.read(1)[0] >> (8 - bits))
+            z.inflateSetDictionary(ctypes.byref(strm), window, len(window))
+            out = ctypes.create_string_buffer(need)
+            strm.next_out = ctypes.addressof(out)
+            strm.avail_out = need
+            inbuf = ctypes.create_string_buffer(InflateIndex.CHUNK)
+            for data in self.compressed(inpos):
+                ctypes.memmove(inbuf, data, len(data))
+                strm.next_in = ctypes.addressof(inbuf)
+                strm.avail_in = len(data)
+                ret = z.inflate(ctypes.byref(strm), 0)
+                if ret < 0 and ret != -5:
+                    raise Exception(f"inflate failed ({ret})")
+                if ret == 1 or strm.avail_out == 0:
+                    break
+            return out.raw[:need - strm.avail_out]
+        finally:
+            z.inflateEnd(ctypes.byref(strm))
+
+    def span(self, n):
+        data = self.spans.get(n)
+        if data is not None:
+            self.spans.move_to_end(n)
+            return data
+        outpos, inpos, bits, window = self.index.points[n]
+        if n + 1 < len(self.index.points):
+            need = self.index.points[n + 1][0] - outpos
+        else:
+            need = self.index.size - outpos
+        if bits:
+            data = self.inflate_primed(inpos, bits, window, need)
+        else:
+            d = zlib.decompressobj(-15, zdict=window)
+            out = []
+            got = 0
+            for chunk in self.compressed(inpos):
+                while chunk and got < need:
+                    piece = d.decompress(chunk, need - got)
+                    out.append(piece)
+                    got += len(piece)
+                    chunk = d.unconsumed_tail
+                if got >= need or d.eof:
+                    break
+            data = b''.join(out)
+        STATS.count('bytes_inflated', len(data))
+        self.spans[n] = data
+        if len(self.spans) > self.maxspans:
+            self.spans.popitem(last=False)
+        return data
+
+    def read(self, count=-1):
+        if count < 0:
+            count = max(self.index.size - self.pos, 0)
+        end = min(self.pos + count, self.index.size)
+        out = []
+        while self.pos < end:
+            n = bisect.bisect_right(self.index.outs, self.pos) - 1
+            data = self.span(n)
+            o = self.pos - self.index.points[n][0]
+            piece = data[o:o + end - self.pos]
+            if not piece:
+                raise Exception("compressed section truncated")
+            out.append(piece)
+            self.pos += len(piece)
+        return b''.join(out)
+
+    def reads(self, fmt):
+        fmt = '=' + fmt
+        i = struct.calcsize(fmt)
+        ret = struct.unpack(fmt, self.read(i))
+        if type(ret) == tuple and len(ret) == 1:
+            return ret[0]
+        return ret
+
+    def seek(self, off):
+        self.pos = off
+
+    def tell(self):
+        return self.pos
+
+    def write(self, data):
+        raise NotImplementedError("database was opened read-only")
+
+
 class Entry:
+    __slots__ = ('i', 'recofs', 'keylen', 'rawkey', 'key', 'vallen', 'val')
+
     def __init__(self, i):
         self.i = i
         self.recofs = None
@@ -285,13 +950,6 @@ class Entry:
         self.vallen = None
         self.val = None
 
-    def read_data(self, args, br: BytesReader, prevkey):
-        br.seek(self.recofs)
-        self.keylen = br.reads("H")
-        self.rawkey = br.read(self.keylen)
-        self.vallen = br.reads("H")
-        self.val = br.read(self.vallen)
-
     def write_data(self, bw: BytesWriter):
         bw.seek(self.recofs)
         bw.writes("H", self.keylen)
@@ -316,69 +974,79 @@ class Entry:
 
 
 class IndexEntry(Entry):
+    __slots__ = ('npage',)
+
     def __init__(self, i):
         super().__init__(i)
         self.npage = 0
 
-    def read_head(self, br: BytesReader):
-        self.npage, self.recofs = br.reads("LH")
+    @classmethod
+    def promote(cls, ent):
+        """ index entry with the same key and value as `ent` """
+        if isinstance(ent, cls):
+            return ent
+        new = cls(ent.i)
+        new.key = ent.key
+        new.val = ent.val
+        return new
 
     def write_head(self, bw: BytesWriter):
         bw.writes("LH", self.npage, self.recofs)
 
-    def read_data(self, args, br: BytesReader, prevkey):
-        super().read_data(args, br, prevkey)
-        self.key = self.rawkey
-
 class LeafEntry(Entry):
+    __slots__ = ('indent', 'unk')
+
     def __init__(self, i):
         super().__init__(i)
         self.indent = 0
         self.unk = 0
 
-    def read_head(self, br: BytesReader):
-        self.indent, self.unk, self.recofs = br.reads("HHH")
-
     def write_head(self, bw: BytesWriter):
         bw.writes("HHH", self.indent, self.unk, self.recofs)
 
-    def read_data(self, args, br, prevkey):
-        super().read_data(args, br, prevkey)
-        self.key = prevkey[:self.indent] + self.rawkey
-
 class Page:
+    """
+    Entry heads are kept as the array of 16 bit words they are stored as:
+    (indent, unk, recofs) for leaf pages, (npage low, npage high, recofs) for index pages.
+    Keys and values are decoded on first access. Entry objects are only made
+    when the page is rebuilt.
+    """
+    __slots__ = ('i', 'fh', 'pagesize', 'offset', 'data', 'preceding', 'entrycount', 'heads',
+                 'unk', 'datastart', 'keys', 'vals')
+
     def __init__(self, fh, i, pagesize):
         self.i = i
         self.fh = fh
+        self.pagesize = pagesize
         self.offset = fh.tell()
-        br = BytesReader(fh.read(pagesize))
-
-        self.br = br
-        self.preceding, self.entrycount = br.reads("LH")
-        # if self.entrycount == 0 or not args.rename:
-        #     fh.fo.write(br.data)
-        #     return
-
-        self.entryType = LeafEntry
-        if self.preceding:
-            self.entryType = IndexEntry
+        self.parse(fh.read(pagesize))
 
-        self.entries = []
-        for i in range(self.entrycount):
-            ent = self.entryType(i)
-            ent.read_head(br)
-            self.entries.append(ent)
-        self.unk, self.datastart = br.reads("LH")
-        self.free_bytes = self.datastart - br.tell()
-
-        prevkey = b''
-        for ent in self.entries:
-            ent.read_data(args, br, prevkey)
-            prevkey = ent.key
-            if ent.recofs < self.datastart:
-                raise NotImplementedError("unexpected entry data before page.datastart")
-
-        self.modifications = 0
+    def parse(self, data):
+        if len(data) < self.pagesize:
+            raise Exception("read overrun")
+        self.data = data
+        self.preceding, self.entrycount = struct.unpack_from("=LH", data, 0)
+        headend = 6 + 6 * self.entrycount
+        if headend + 6 > self.pagesize:
+            raise Exception("read overrun")
+        self.heads = array('H')
+        self.heads.frombytes(data[6:headend])
+        self.unk, self.datastart = struct.unpack_from("=LH", data, headend)
+        self.keys = None
+        self.vals = None
+
+        if self.entrycount and min(self.heads[2::3]) < self.datastart:
+            raise NotImplementedError("unexpected entry data before page.datastart")
+
+    @classmethod
+    def create(cls, fh, i, pagesize, offset, preceding):
+        """ new empty page, index page if `preceding` is set """
+        page = cls(io.BytesIO(bytes(pagesize)), i, pagesize)
+        page.fh = fh
+        page.offset = offset
+        page.preceding = preceding
+        page.rebuild([])
+        return page
 
     def isindex(self):
         return self.preceding != 0
@@ -386,8 +1054,61 @@ class Page:
     def isleaf(self):
         return self.preceding == 0
 
+    def recofs(self, ix):
+        return self.heads[3 * ix + 2]
+
+    def rawkey(self, ix):
+        ofs = self.recofs(ix)
+        keylen, = struct.unpack_from("=H", self.data, ofs)
+        return bytes(self.data[ofs + 2:ofs + 2 + keylen])
+
     def getkey(self, ix):
-        return self.entries[ix].key
+        if self.keys is None:
+            if self.isleaf():
+                self.load_keys()
+            else:
+                self.keys = [None] * self.entrycount
+        key = self.keys[ix]
+        if key is None:
+            key = self.keys[ix] = self.rawkey(ix)
+        return key
+
+    def load_keys(self):
+        """ leaf keys are stored as a prefix of the previous key plus a tail,
+        so the whole chain is decoded once when any leaf key is needed """
+        keys = []
+        prevkey = b''
+        heads = self.heads
+        for ix in range(self.entrycount):
+            prevkey = prevkey[:heads[3 * ix]] + self.rawkey(ix)
+            keys.append(prevkey)
+        self.keys = keys
+
+    def loaded_entries(self):
+        """ the entries as objects, with keys and values copied out of the page data """
+        entries = []
+        for ix in range(self.entrycount):
+            if self.isindex():
+                ent = IndexEntry(ix)
+                ent.npage = self.getpage(ix)
+            else:
+                ent = LeafEntry(ix)
+                ent.unk = self.heads[3 * ix + 1]
+            ent.key = bytes(self.getkey(ix))
+            ent.val = bytes(self.getval(ix))
+            entries.append(ent)
+        return entries
+
+    def make_entry(self, key, val, npage=0):
+        """ entry object of the kind this page holds """
+        if self.isindex():
+            ent = IndexEntry(0)
+            ent.npage = npage
+        else:
+            ent = LeafEntry(0)
+        ent.key = key
+        ent.val = val
+        return ent
 
     def find(self, key):
         """
@@ -402,12 +1123,12 @@ class Page:
 
         # for an index entry: the key is 'less' than anything in the page pointed to.
         """
-        i = binary_search(self.entries, key)
+        i = binary_search(self, key)
         if i < 0:
             if self.isindex():
                 return 'recurse', -1
             return 'gt', 0
-        if self.entries[i].key == key:
+        if self.getkey(i) == key:
             return 'eq', i
         if self.isindex():
             return 'recurse', i
@@ -415,84 +1136,251 @@ class Page:
 
     def getpage(self, ix):
         """ For Indexpages, returns the page ptr for the specified entry """
-        return self.preceding if ix < 0 else self.entries[ix].npage
+        if ix < 0:
+            return self.preceding
+        return self.heads[3 * ix] | self.heads[3 * ix + 1] << 16
 
     def getval(self, ix):
-        """ For all page types, returns the value for the specified entry """
-        return self.entries[ix].val
-
-    def rebuild_modify(self, ix, newval):
-        total_expand = 0
-        for ent in sorted(self.entries, key=lambda e: e.recofs, reverse=True):
-            # walk page entries data backwards and move left if expanded
-            if ent.i == ix:
-                total_expand += len(newval) - ent.vallen
-                ent.val = newval
-                ent.vallen = len(newval)
-            ent.recofs -= total_expand
-
-        self.free_bytes -= total_expand
-        if self.free_bytes < 0:
+        """ For all page types, returns the value for the specified entry, a slice of the page data """
+        if self.vals is None:
+            self.vals = [None] * self.entrycount
+        val = self.vals[ix]
+        if val is None:
+            ofs = self.recofs(ix)
+            keylen, = struct.unpack_from("=H", self.data, ofs)
+            ofs += 2 + keylen
+            vallen, = struct.unpack_from("=H", self.data, ofs)
+            val = self.vals[ix] = self.data[ofs + 2:ofs + 2 + vallen]
+        return val
+
+    def size_with(self, entries):
+        """ bytes taken by the page if it held these entries """
+        size = 12  # page header and the last head holding datastart
+        prevkey = b''
+        for ent in entries:
+            keylen = len(ent.key)
+            if self.isleaf():
+                keylen -= common_prefix(prevkey, ent.key)
+                prevkey = ent.key
+            size += 6 + 4 + keylen + len(ent.val)
+        return size
+
+    def rebuild(self, entries):
+        """ lays out the page again: heads after the page header,
+        entry data packed towards the end of the page """
+        if self.size_with(entries) > self.pagesize:
             raise NotImplementedError("no more space in this page")
+        pos = self.pagesize
+        prevkey = b''
+        for i, ent in enumerate(entries):
+            ent.i = i
+            if self.isleaf():
+                ent.indent = common_prefix(prevkey, ent.key)
+                ent.rawkey = ent.key[ent.indent:]
+                prevkey = ent.key
+            else:
+                ent.rawkey = ent.key
+            ent.keylen = len(ent.rawkey)
+            ent.vallen = len(ent.val)
+            pos -= 4 + ent.keylen + ent.vallen
+            ent.recofs = pos
+
+        bw = BytesWriter(bytes(self.pagesize))
+        bw.writes("LH", self.preceding, len(entries))
+        for ent in entries:
+            ent.write_head(bw)
+        bw.writes("LH", self.unk, pos)
+        for ent in entries:
+            ent.write_data(bw)
+        if bw.coverage is not None:
+            print(f'  page {self.i} coverage {bw.get_coverage()}')
+        STATS.count('pages_rebuilt')
+        self.parse(bw.data)
+        self.keys = [ent.key for ent in entries]
+        self.vals = [ent.val for ent in entries]
 
-        self.datastart -= total_expand
-        self.prepare_save()
+    def save(self):
+        self.fh.seek(self.offset)
+        self.fh.write(self.data)
+        STATS.count('pages_written')
+
+    def check(self, lo=None, hi=None):
+        """ returns problems found in the page layout and key order,
+        all keys must be between `lo` and `hi` of the parent page """
+        problems = []
+        headend = 12 + 6 * self.entrycount
+        if not headend <= self.datastart <= self.pagesize:
+            return [f'datastart {self.datastart} outside of {headend}..{self.pagesize}']
+        prevkey = lo
+        for ix in range(self.entrycount):
+            recofs = self.recofs(ix)
+            if not self.datastart <= recofs <= self.pagesize - 4:
+                problems.append(f'entry {ix} recofs {recofs} outside of {self.datastart}..{self.pagesize}')
+                return problems
+            indent = self.heads[3 * ix]
+            if self.isleaf() and ix and indent > len(prevkey):
+                problems.append(f'entry {ix} indent {indent} longer than previous key')
+            keylen, = struct.unpack_from("=H", self.data, recofs)
+            if recofs + 4 + keylen > self.pagesize or \
+                    recofs + 4 + keylen + struct.unpack_from("=H", self.data, recofs + 2 + keylen)[0] > self.pagesize:
+                problems.append(f'entry {ix} data beyond end of page')
+                return problems
+            key = self.getkey(ix)
+            if prevkey is not None and key <= prevkey:
+                problems.append(f'entry {ix} key {hexdump(key)} not above {hexdump(prevkey)}')
+            prevkey = key
+        if hi is not None and self.entrycount and self.getkey(self.entrycount - 1) >= hi:
+            problems.append(f'last key {hexdump(self.getkey(self.entrycount - 1))} not below {hexdump(hi)}')
+        return problems
+
+
+class LoaderLevel:
+    """ page being filled at one level of a b-tree under construction """
+
+    def __init__(self, preceding):
+        self.reset(preceding)
+
+    def reset(self, preceding):
+        self.preceding = preceding
+        self.entries = []
+        self.size = 12
+        self.lastkey = b''
+        # entry which did not fit, placed once it is known if more entries follow
+        self.pending = None
 
-    def rebuild_insert_entry(self, entry_i, entry_key, entry_val):
-        ent = self.entryType(entry_i)
-        self.entries.insert(entry_i, ent)
-        self.entrycount += 1
+    def entry_size(self, ent):
+        keylen = len(ent.key)
+        if not self.preceding:
+            keylen -= common_prefix(self.lastkey, ent.key)
+        return 10 + keylen + len(ent.val)
 
-        ent.key = entry_key
+    def append(self, ent, size):
+        self.entries.append(ent)
+        self.size += size
+        self.lastkey = ent.key
 
-        if self.isleaf():
-            prevkey = self.entries[entry_i - 1].key
-            ent.indent = 0
-            for a, b in zip(prevkey, entry_key):
-                if a == b:
-                    ent.indent += 1
-                else:
-                    break
-            ent.rawkey = entry_key[ent.indent:]
-        else:
-            ent.rawkey = entry_key
 
-        ent.keylen = len(ent.rawkey)
-        ent.val = entry_val
-        ent.vallen = len(entry_val)
-
-        headlen = 6
-        datalen = 2 + ent.vallen + 2 + ent.keylen
-        entlen = headlen + datalen
-
-        self.free_bytes -= entlen
-        if self.free_bytes < 0:
-            raise NotImplementedError("no more space in this page")
+class BTreeLoader:
+    """
+    Builds a b-tree bottom-up from entries added in key order.
+    Pages are filled up to `fill` of the page size, and written to `fh` as soon as
+    they are complete, numbered from 1 in that order. Page 0 is left to the caller.
 
-        ent.recofs = self.datastart - entlen
-        self.datastart = ent.recofs
-        self.prepare_save()
+    When an entry does not fit, it goes up one level once the next entry shows up,
+    the page that entry then starts becomes its child.
+    The right edge of the tree is fixed in finish(), so no page ends up empty.
+    """
 
-    def prepare_save(self):
-        if self.modifications == 0:
-            self.bw = BytesWriter(self.br.data)
+    def __init__(self, fh, pagesize, fill=0.9):
+        if not 0.1 <= fill <= 1:
+            raise ValueError("fill factor must be between 0.1 and 1")
+        self.fh = fh
+        self.pagesize = pagesize
+        self.limit = int(pagesize * fill)
+        self.levels = [LoaderLevel(0)]
+        self.npages = 0
+        self.count = 0
+
+    def add(self, key, val):
+        ent = LeafEntry(self.count)
+        ent.key = key
+        ent.val = val
+        self.push(0, ent)
+        self.count += 1
+
+    def push(self, k, ent):
+        lv = self.levels[k]
+        if lv.pending is not None:
+            up = lv.pending
+            lv.pending = None
+            self.attach(k + 1, self.flush(k))
+            lv.reset(up.npage if k else 0)
+            self.push(k + 1, IndexEntry.promote(up))
+        size = lv.entry_size(ent)
+        if lv.entries and lv.size + size > self.limit:
+            lv.pending = ent
         else:
-            self.bw.seek(0)
+            lv.append(ent, size)
+
+    def attach(self, k, nr):
+        """ links finished page `nr` as the next child of level `k` """
+        if k == len(self.levels):
+            self.levels.append(LoaderLevel(nr))
+            return
+        lv = self.levels[k]
+        parent = lv.pending or lv.entries[-1]
+        parent.npage = nr
+
+    def flush(self, k):
+        lv = self.levels[k]
+        self.npages += 1
+        nr = self.npages
+        page = Page.create(self.fh, nr, self.pagesize, nr * self.pagesize, lv.preceding)
+        page.rebuild(lv.entries)
+        page.save()
+        return nr
+
+    def finish(self):
+        """ writes the remaining pages, returns number of the root page """
+        k = 0
+        while True:
+            lv = self.levels[k]
+            if lv.pending is not None:
+                ent = lv.pending
+                lv.pending = None
+                size = lv.entry_size(ent)
+                if lv.size + size <= self.pagesize:
+                    lv.append(ent, size)
+                else:
+                    # no more entries follow: the last one placed goes up instead
+                    if len(lv.entries) < 2:
+                        raise NotImplementedError("entry does not fit in a page")
+                    up = lv.entries.pop()
+                    self.attach(k + 1, self.flush(k))
+                    lv.reset(up.npage if k else 0)
+                    self.push(k + 1, IndexEntry.promote(up))
+                    lv.append(ent, lv.entry_size(ent))
+            nr = self.flush(k)
+            if k + 1 == len(self.levels):
+                return nr
+            self.attach(k + 1, nr)
+            k += 1
+
+
+class PageCache:
+    """
+    Keeps recently read pages, least recently used ones are evicted
+    once either `maxpages` or `maxbytes` limit is exceeded.
+    """
 
-        self.bw.writes("LH", self.preceding, self.entrycount)
+    def __init__(self, pagesize, maxpages=None, maxbytes=None):
+        self.pagesize = pagesize
+        self.maxpages = maxpages
+        self.maxbytes = maxbytes
+        self.pages = OrderedDict()
 
-        for ent in self.entries:
-            ent.write_head(self.bw)
+    def get(self, nr):
+        page = self.pages.get(nr)
+        if page is None:
+            return None
+        self.pages.move_to_end(nr)
+        return page
 
-        self.bw.writes("LH", self.unk, self.datastart)
-        for ent in self.entries:
-            ent.write_data(self.bw)
+    def put(self, page):
+        self.pages[page.i] = page
+        self.pages.move_to_end(page.i)
+        while self.pages and self.full():
+            self.pages.popitem(last=False)
 
-        self.modifications += 1
+    def discard(self, nr):
+        self.pages.pop(nr, None)
 
-    def save(self):
-        self.fh.seek(self.offset)
-        self.fh.write(self.bw.data)
+    def full(self):
+        if self.maxpages is not None and len(self.pages) > self.maxpages:
+            return True
+        if self.maxbytes is not None and len(self.pages) * self.pagesize > self.maxbytes:
+            return True
+        return False
 
 
 class Cursor:
@@ -515,10 +1403,10 @@ class Cursor:
         if page.isleaf():
             # from leaf move towards root
             ix += 1
-            while self.stack and ix == len(page.entries):
+            while self.stack and ix == page.entrycount:
                 page, ix = self.stack.pop()
                 ix += 1
-            if ix < len(page.entries):
+            if ix < page.entrycount:
                 self.stack.append((page, ix))
         else:
             # from node move towards leaf
@@ -542,13 +1430,50 @@ class Cursor:
             if ix >= 0:
                 self.stack.append((page, ix))
         else:
-            # move towards leaf
+            # move towards leaf, to the last entry of the child before this entry
             self.stack.append((page, ix))
             while page.isindex():
                 page = self.db.readpage(page.getpage(ix))
-                ix = len(page.index) - 1
+                ix = page.entrycount - 1
                 self.stack.append((page, ix))
 
+    def seek(self, key):
+        """
+        Moves the cursor to the entry nearest to `key` and returns how it relates to `key`,
+        like Page.find does: 'eq', 'lt' or 'gt'. Only climbs from the current position
+        until reaching a page whose subtree holds `key`, so seeking to keys in ascending
+        order visits each page on the way about once.
+        """
+        stack = self.stack
+        # keep the deepest page whose subtree holds `key`: the keys below a page lie between
+        # the nearest entries on either side of the path in the pages above it
+        keep = 0
+        lo = hi = None
+        for depth, (page, ix) in enumerate(stack[:-1]):
+            if ix >= 0:
+                lo = page.getkey(ix)
+            if ix + 1 < page.entrycount:
+                hi = page.getkey(ix + 1)
+            if (lo is not None and key <= lo) or (hi is not None and key >= hi):
+                break
+            keep = depth + 1
+        del stack[keep + 1:]
+        STATS.count('seeks')
+        if len(stack) > 1:
+            page, _ = stack.pop()
+        else:
+            stack.clear()
+            page = self.db.readpage(self.db.firstindex)
+            STATS.count('descents')
+        while True:
+            response, ix = page.find(key)
+            stack.append((page, ix))
+            if len(stack) == 256:
+                raise Exception("b-tree corrupted")
+            if response != 'recurse':
+                return response
+            page = self.db.readpage(page.getpage(ix))
+
     def eof(self):
         return len(self.stack) == 0
 
@@ -570,6 +1495,13 @@ class Cursor:
     def __repr__(self):
         return "cursor:" + repr(self.stack)
 
+# IDA stores blobs in parts of at most 1 KiB, at consecutive indices
+BLOB_PART_SIZE = 0x400
+
+def blob_part_size(pagesize):
+    """ smaller parts only for pages too small to hold a few of them """
+    return min(BLOB_PART_SIZE, pagesize // 4)
+
 def makekey_name_tag(nodeid, tag):
     return struct.pack('>sQs', b'.', nodeid, tag.encode('utf-8'))
 
@@ -577,6 +1509,8 @@ def makekey_name_tag_start(nodeid, tag, start):
     return struct.pack('>sQsQ', b'.', nodeid, tag.encode('utf-8'), start)
 
 class IDBFile:
+    SECTIONS = ('ID0', 'ID1', 'NAM', 'SEG', 'TIL', 'ID2')
+
     def __init__(self, fh: FileHandler):
         self.fh = fh
         magic = fh.read(6)
@@ -594,11 +1528,28 @@ class IDBFile:
         comp, size = self.fh.reads("BQ")
         # print(f"moving section {i} from {self.offsets[i]}..{self.offsets[i] + size} "
         #       f"to {self.offsets[i] + amount}..{self.offsets[i] + amount + size}")
-        sect_data = self.fh.read(size)
-        self.fh.seek(self.offsets[i] + amount)
-        self.fh.writes("BQ", comp, size)
-        self.fh.write(sect_data)
+        self.fh.move(self.offsets[i], self.offsets[i] + amount, 9 + size)
         self.offsets[i] += amount
+        STATS.count('sections_moved')
+        STATS.count('bytes_moved', 9 + size)
+
+    def following(self, i):
+        """ sections stored after section i """
+        return [j for j, o in enumerate(self.offsets) if o > self.offsets[i]]
+
+    def room(self, i):
+        """ bytes available for data of section i before the next section starts """
+        following = self.following(i)
+        if not following:
+            return None
+        return min(self.offsets[j] for j in following) - self.offsets[i] - 9
+
+    def move_following(self, i, amount):
+        """ moves all sections after section i by `amount`, the last one first """
+        with STATS.timer('move_sections'):
+            for j in sorted(self.following(i), key=lambda j: self.offsets[j], reverse=True):
+                self.move_section(j, amount)
+            self.write_head()
 
     def write_head(self):
         self.fh.seek(6)
@@ -608,36 +1559,123 @@ class IDBFile:
             self.head[p] = self.checksums[o]
         self.fh.writes("QQLLHQQQ5LQL", *self.head)
 
+    def section_data(self, i):
+        """ offset and size of the stored data of section i, after its compression and size fields """
+        self.fh.seek(self.offsets[i])
+        comp, size = self.fh.reads("BQ")
+        return self.offsets[i] + 9, size
+
+    def section_crc(self, i):
+        return self.fh.crc32(*self.section_data(i))
+
+    def compute_checksums(self):
+        """ crc32 of all sections, each one hashed in its own thread """
+        present = [i for i, o in enumerate(self.offsets) if o]
+        extents = [self.section_data(i) for i in present]
+        crcs = [0] * len(self.offsets)
+        with ThreadPoolExecutor(len(present) or 1) as pool:
+            for i, crc in zip(present, pool.map(lambda ext: self.fh.crc32(*ext), extents)):
+                crcs[i] = crc
+        return crcs
+
+    def verifycrc(self):
+        errcode = 0
+        for i, crc in enumerate(self.compute_checksums()):
+            if self.offsets[i] == 0:
+                continue
+            status = 'ok' if crc == self.checksums[i] else 'MISMATCH'
+            if crc != self.checksums[i]:
+                errcode = 1
+            print(f'section {self.SECTIONS[i]}: stored {self.checksums[i]:08x}, computed {crc:08x} {status}')
+        print('crc check complete')
+        return errcode
+
 
 class ID0:
-    def __init__(self, idb: IDBFile):
+    def __init__(self, idb: IDBFile, cache_pages=1024, cache_bytes=None, use_mmap=True,
+                 mem_limit=None, index_path=None, deflate_block=0x20000, deflate_workers=None, slack=0):
         self.idb = idb
         ofh = idb.fh
         ofh.seek(self.idb.offsets[0])
         self.ofh = ofh
         self.comp, self.size = ofh.reads("BQ")
         self.modified = False
+        self.rewrite = False
+        self.datasize = self.size
+        self.mem_limit = mem_limit
+        self.deflate_block = deflate_block
+        self.deflate_workers = deflate_workers
+        self.slack = slack
         if self.comp == 0:
             self.fs = ofh
+            if use_mmap:
+                try:
+                    self.fs = MappedFile(ofh.f, ofh.tell())
+                except (OSError, ValueError):
+                    pass
         elif self.comp == 2:
-            self.fs = io.BytesIO(zlib.decompress(ofh.read(self.size), 15))
+            index = None
+            if index_path:
+                # read-only use, decompress on demand with help of a checkpoint index
+                st = os.stat(idb.fh.filename)
+                key = struct.pack('<QQQQ6L', st.st_size, st.st_mtime_ns, self.idb.offsets[0], self.size,
+                                  *self.idb.checksums)
+                index = InflateIndex.open(index_path, ofh, self.size, key)
+            if index:
+                self.fs = IndexedFile(ofh, index)
+                self.datasize = index.size
+            else:
+                with STATS.timer('inflate'):
+                    self.fs, self.datasize = inflate(ofh, self.size, mem_limit)
         else:
             raise NotImplementedError("unsupported compression type")
 
         self.start = self.fs.tell()
-        btreedata = self.fs.read(64)
+        btreedata = bytes(self.fs.read(64))
         self.firstfree, self.pagesize, self.firstindex, \
             self.reccount, self.pagecount = unpack("LHLLL", btreedata)
         if not btreedata[19:].startswith(b"B-tree v2"):
             raise NotImplementedError("unknown b-tree format")
 
-        self.fdl = FuncDirList(self)
         self.edits = {}
+        self.cache = PageCache(self.pagesize, cache_pages, cache_bytes)
+
+    @cached_property
+    def fdl(self):
+        with STATS.timer('load_folders'):
+            return FuncDirList(self)
+
+    def reopen(self):
+        """ in a forked process: the file position is shared with the parent, so take an own handle """
+        fh = FileHandler(self.ofh.filename)
+        if self.fs is self.ofh:
+            self.fs = fh
+        elif isinstance(self.fs, IndexedFile):
+            self.fs.fh = fh
+        self.ofh = fh
 
     def readpage(self, nr):
-        """ reads from file """
+        """ returns modified page if there is one, otherwise cached or read from file """
+        page = self.edits.get(nr)
+        if page is None:
+            page = self.cache.get(nr)
+        if page is not None:
+            STATS.count('page_cache_hits')
+            return page
         self.fs.seek(self.start + nr * self.pagesize)
-        return Page(self.fs, nr, self.pagesize)
+        page = Page(self.fs, nr, self.pagesize)
+        STATS.count('pages_read')
+        self.cache.put(page)
+        return page
+
+    def editpage(self, nr):
+        """ returns page to be modified, it stays in memory until saved """
+        page = self.edits.get(nr)
+        if page is None:
+            page = self.readpage(nr)
+            self.cache.discard(nr)
+            self.edits[nr] = page
+        return page
 
     def namekey(self, name):
         if type(name) == int:
@@ -654,7 +1692,23 @@ class ID0:
         if not cur:
             print("%x has no name" % ea)
             return
-        data = cur.getval()
+        return self.decode_name(cur.getval())
+
+    def nameof_many(self, eas):
+        """ resolves names of many addresses in a single sweep in key order,
+        returns {ea: name}, addresses without a name are left out """
+        names = {}
+        cur = Cursor(self, [])
+        STATS.count('name_sweeps')
+        for ea in sorted(set(eas)):
+            # climbs only as far as the next key needs, mostly not out of the current leaf
+            if cur.seek(makekey_name_tag(ea, 'N')) == 'eq':
+                names[ea] = self.decode_name(cur.getval())
+        STATS.count('names_found', len(names))
+        return names
+
+    def decode_name(self, data):
+        data = bytes(data)
         if data[:1] == b'\x00':
             raise NotImplementedError
             # nameid, = struct.unpack_from("Q", data, 1)
@@ -662,20 +1716,27 @@ class ID0:
             # return nameblob.rstrip(b"\x00").decode('utf-8')
         return data.rstrip(b"\x00").decode('utf-8')
 
-    def find(self, request, key):
-        # descend tree to leaf nearest to the `key`
-        page = self.readpage(self.firstindex)
-        stack = []
-        while True:
-            response, ix = page.find(key)
-            stack.append((page, ix))
-            if len(stack) == 256:
-                raise Exception("b-tree corrupted")
-            if response != 'recurse':
-                break
-            page = self.readpage(page.getpage(ix))
+    def descend(self, key):
+        """ walks from the root to the entry nearest to `key`, returns the path
+        as a list of (page, index) and how the last entry relates to `key` """
+        cursor = Cursor(self, [])
+        response = cursor.seek(key)
+        return cursor.stack, response
 
-        cursor = Cursor(self, stack)
+    def find(self, request, key, cursor=None):
+        """
+        Returns a cursor at the entry matching `request` ('eq', 'lt', 'le', 'gt', 'ge') for `key`,
+        None if there is no 'eq' match. A `cursor` given is moved from where it is,
+        instead of descending from the root.
+        """
+        STATS.count('finds')
+        if cursor is None:
+            cursor = Cursor(self, [])
+        response = cursor.seek(key)
+        if not cursor.stack[-1][0].entrycount:
+            # only the root page of an empty tree has no entries
+            cursor.stack.clear()
+            return None if request == 'eq' else cursor
 
         # now correct for what was actually asked.
         if response == request:
@@ -695,51 +1756,531 @@ class ID0:
 
         return cursor
 
+    def last(self):
+        """ cursor at the last entry of the tree """
+        stack = []
+        page = self.readpage(self.firstindex)
+        while page.isindex():
+            stack.append((page, page.entrycount - 1))
+            page = self.readpage(page.getpage(page.entrycount - 1))
+        if page.entrycount:
+            stack.append((page, page.entrycount - 1))
+        return Cursor(self, stack)
+
+    def scan(self, start=b'', stop=None, reverse=False):
+        """
+        Yields a cursor positioned at each entry with `start` <= key < `stop` in key order,
+        to the end of the tree if `stop` is None, from the last one backwards if `reverse`.
+        One cursor walks the whole range, so only the pages in it are read, each once.
+        """
+        if reverse:
+            cur = self.find('lt', stop) if stop is not None else self.last()
+            while not cur.eof() and cur.getkey() >= start:
+                yield cur
+                cur.prev()
+            return
+        cur = self.find('ge', start)
+        while not cur.eof():
+            if stop is not None and cur.getkey() >= stop:
+                break
+            yield cur
+            cur.next()
+
+    def iterate(self, start=b'', stop=None, reverse=False):
+        """ yields (key, value) of entries with `start` <= key < `stop` """
+        for cur in self.scan(start, stop, reverse):
+            yield cur.getkey(), cur.getval()
+
+    def prefix(self, prefix, reverse=False):
+        """ yields (key, value) of entries with keys starting with `prefix` """
+        return self.iterate(prefix, prefix_end(prefix), reverse)
+
     def blob(self, nodeid, tag, start=0, end=0xFFFFFFFF):
         """ returns combined data between multiple entries and all affected pages"""
 
         startkey = makekey_name_tag_start(nodeid, tag, start)
         endkey = makekey_name_tag_start(nodeid, tag, end)
-        cur = self.find('ge', startkey)
-        data = b''
+        chunks = []
         affected = []
-        while cur.getkey() <= endkey:
+        for cur in self.scan(startkey, prefix_end(endkey)):
             page, entry_i = cur.getpageix()
             affected.append((page.i, entry_i))
-            chunk = page.entries[entry_i].val
-            data += chunk
-            cur.next()
+            chunks.append(cur.getval())
+        data = b''.join(chunks)
         affected = remove_duplicates(affected)
+        STATS.count('blobs')
+        STATS.count('blob_bytes', len(data))
         return data, affected
 
+    def modify(self, key, val):
+        """ replaces value of an existing entry, returns its page and entry number """
+        stack, response = self.descend(key)
+        if response != 'eq':
+            raise KeyError(f"no entry {hexdump(key)}")
+        page, ix = stack.pop()
+        entries = page.loaded_entries()
+        entries[ix].val = val
+        self.store(stack, page, entries)
+        self.modified = True
+        return self.locate(key)
+
+    def insert(self, key, val):
+        """ adds a new entry to the leaf page where its key belongs, returns its page and entry number """
+        stack, response = self.descend(key)
+        if response == 'eq':
+            raise KeyError(f"entry {hexdump(key)} already exists")
+        page, ix = stack.pop()
+        if response == 'lt':
+            ix += 1
+        ent = LeafEntry(ix)
+        ent.key = key
+        ent.val = val
+        entries = page.loaded_entries()
+        entries.insert(ix, ent)
+        self.store(stack, page, entries)
+        self.reccount += 1
+        self.modified = True
+        return self.locate(key)
+
+    def delete(self, key):
+        """ removes an existing entry """
+        stack, response = self.descend(key)
+        if response != 'eq':
+            raise KeyError(f"no entry {hexdump(key)}")
+        page, ix = stack.pop()
+        if page.isindex():
+            # the entry before it in key order, the last one of the leaf at the right edge
+            # of its left subtree, takes its place and is then removed from that leaf
+            entries = page.loaded_entries()
+            leaf = self.readpage(page.getpage(ix - 1))
+            while leaf.isindex():
+                leaf = self.readpage(leaf.getpage(leaf.entrycount - 1))
+            last = leaf.entrycount - 1
+            entries[ix] = page.make_entry(bytes(leaf.getkey(last)), bytes(leaf.getval(last)), entries[ix].npage)
+            self.store(stack, page, entries)
+
+            # the key is now in both pages, descending stops at the index page
+            stack, response = self.descend(entries[ix].key)
+            page, ix = stack.pop()
+            stack.append((page, ix - 1))
+            page = self.readpage(page.getpage(ix - 1))
+            while page.isindex():
+                stack.append((page, page.entrycount - 1))
+                page = self.readpage(page.getpage(page.entrycount - 1))
+            ix = page.entrycount - 1
+        entries = page.loaded_entries()
+        del entries[ix]
+        self.refill(stack, page, entries)
+        self.reccount -= 1
+        self.modified = True
+
+    def refill(self, stack, page, entries):
+        """
+        Rebuilds a page which lost an entry. A page left empty gets the parent entry
+        next to it and a sibling's nearest entry goes up in its place; when the sibling
+        has only one entry, the two pages are merged, which takes an entry from the parent.
+        """
+        page = self.editpage(page.i)
+        if entries or not stack:
+            page.rebuild(entries)
+            return
+        parent, pix = stack.pop()
+        pentries = parent.loaded_entries()
+        # an empty index page still has one child, its preceding page
+        child = page.preceding
+        if pix >= 0:
+            sibling = self.editpage(parent.getpage(pix - 1))
+            sep = pentries[pix]
+            sentries = sibling.loaded_entries()
+            if len(sentries) > 1:
+                up = sentries.pop()
+                if page.isindex():
+                    page.preceding = up.npage
+                sibling.rebuild(sentries)
+                page.rebuild([page.make_entry(sep.key, sep.val, child)])
+                pentries[pix] = parent.make_entry(up.key, up.val, page.i)
+                self.store(stack, parent, pentries)
+                return
+            merged = sibling
+            merged_entries = sentries + [page.make_entry(sep.key, sep.val, child)]
+            del pentries[pix]
+            gone = page
+        else:
+            sibling = self.editpage(parent.getpage(0))
+            sep = pentries[0]
+            sentries = sibling.loaded_entries()
+            if len(sentries) > 1:
+                up = sentries.pop(0)
+                page.rebuild([page.make_entry(sep.key, sep.val, sibling.preceding)])
+                if sibling.isindex():
+                    sibling.preceding = up.npage
+                sibling.rebuild(sentries)
+                pentries[0] = parent.make_entry(up.key, up.val, sibling.i)
+                self.store(stack, parent, pentries)
+                return
+            merged = page
+            merged_entries = [page.make_entry(sep.key, sep.val, sibling.preceding)] + sentries
+            del pentries[0]
+            gone = sibling
+        if merged.size_with(merged_entries) > self.pagesize:
+            raise NotImplementedError("entries too large to merge pages")
+        merged.rebuild(merged_entries)
+        self.freepage(gone.i)
+        print(f'  merged page {gone.i} into page {merged.i}')
+        if pentries or stack:
+            self.refill(stack, parent, pentries)
+        else:
+            # the root lost its last entry, its only child is the new root
+            self.freepage(parent.i)
+            self.firstindex = merged.i
+            print(f'  new root page {merged.i}')
+
+    def locate(self, key):
+        page, ix = self.find('eq', key).getpageix()
+        return page.i, ix
+
+    def store(self, stack, page, entries):
+        """
+        Rebuilds page with new list of entries. If they don't fit, the page is split:
+        the middle entry moves up to the parent page and points to a new page holding
+        the entries after it. `stack` is the path from the root to this page.
+        """
+        page = self.editpage(page.i)
+        if page.size_with(entries) <= self.pagesize:
+            page.rebuild(entries)
+            return
+        if len(entries) < 3:
+            raise NotImplementedError("entry does not fit in a page")
+
+        # split where about half of the data is on each side
+        sizes = [10 + len(ent.key) + len(ent.val) for ent in entries]
+        half = sum(sizes) // 2
+        total = 0
+        for m, size in enumerate(sizes):
+            total += size
+            if total >= half:
+                break
+        m = min(max(m, 1), len(entries) - 2)
+
+        up = IndexEntry.promote(entries[m])
+        # for index pages, the child of the middle entry becomes the new page's first child
+        right = self.allocpage(up.npage if page.isindex() else 0)
+        up.npage = right.i
+        page.rebuild(entries[:m])
+        right.rebuild(entries[m + 1:])
+        print(f'  split page {page.i}, new page {right.i}')
+
+        if stack:
+            parent, ix = stack.pop()
+            parent_entries = parent.loaded_entries()
+            parent_entries.insert(ix + 1, up)
+            self.store(stack, parent, parent_entries)
+        else:
+            root = self.allocpage(page.i)
+            root.rebuild([up])
+            self.firstindex = root.i
+            print(f'  new root page {root.i}')
+
+    def allocpage(self, preceding):
+        """ takes a page from the free list, or adds one at the end """
+        if self.firstfree:
+            nr = self.firstfree
+            # free pages are chained through their first field
+            if nr in self.edits:
+                self.firstfree = self.edits[nr].preceding
+            else:
+                self.fs.seek(self.start + nr * self.pagesize)
+                self.firstfree = self.fs.reads("L")
+        else:
+            nr = max(self.pagecount, self.datasize // self.pagesize)
+            self.datasize = (nr + 1) * self.pagesize
+            self.pagecount += 1
+        page = Page.create(self.fs, nr, self.pagesize, self.start + nr * self.pagesize, preceding)
+        self.cache.discard(nr)
+        self.edits[nr] = page
+        return page
+
+    def freepage(self, nr):
+        """ puts a page no longer in the tree on the free list """
+        self.cache.discard(nr)
+        self.edits[nr] = Page.create(self.fs, nr, self.pagesize, self.start + nr * self.pagesize, self.firstfree)
+        self.firstfree = nr
+
+    def write_header(self):
+        self.fs.seek(self.start)
+        self.fs.write(struct.pack("=LHLLL", self.firstfree, self.pagesize, self.firstindex,
+                                  self.reccount, self.pagecount))
+
+    def compact(self, fill=0.9):
+        """
+        Rebuilds the whole b-tree from its entries in key order, with pages filled
+        up to `fill` of the page size. The new tree is kept in a temporary file
+        and replaces the section data on save.
+        """
+        print('compacting b-tree...')
+        oldpages = self.datasize // self.pagesize
+        out = spooled(self.mem_limit)
+        self.fs.seek(self.start)
+        out.write(bytes(self.fs.read(self.pagesize)))
+
+        loader = BTreeLoader(out, self.pagesize, fill)
+        for key, val in self.iterate():
+            loader.add(key, val)
+        root = loader.finish()
+        if loader.count != self.reccount:
+            print(f'  record count was {self.reccount}, found {loader.count}')
+
+        self.fs = out
+        self.start = 0
+        self.firstfree = 0
+        self.firstindex = root
+        self.reccount = loader.count
+        self.pagecount = loader.npages + 1
+        self.datasize = self.pagecount * self.pagesize
+        self.edits.clear()
+        self.cache = PageCache(self.pagesize, self.cache.maxpages, self.cache.maxbytes)
+        self.rewrite = True
+        self.modified = True
+        print(f'  {oldpages} pages -> {self.pagecount} pages, root page {root}')
+
+    def check_subtree(self, nr, lo, hi, depth):
+        """
+        Walks the subtree under page `nr`, whose keys must be between `lo` and `hi`.
+        Returns (problems, number of entries, page numbers, depths of leaf pages).
+        """
+        problems = []
+        count = 0
+        pages = []
+        depths = set()
+        lastpage = self.datasize // self.pagesize
+        todo = [(nr, lo, hi, depth)]
+        while todo:
+            nr, lo, hi, depth = todo.pop()
+            if not 0 < nr < lastpage:
+                problems.append(f'page number {nr} outside of 1..{lastpage - 1}')
+                continue
+            if depth >= 256:
+                problems.append(f'page {nr}: b-tree deeper than 256 levels, pages form a loop')
+                continue
+            pages.append(nr)
+            try:
+                page = self.readpage(nr)
+                count += page.entrycount
+                page_problems = page.check(lo, hi)
+            except Exception as e:
+                page_problems = [f'cannot be parsed: {e}']
+            if page_problems:
+                problems.extend(f'page {nr}: {p}' for p in page_problems)
+                continue
+            if page.isleaf():
+                depths.add(depth)
+                continue
+            keys = [lo] + [page.getkey(ix) for ix in range(page.entrycount)] + [hi]
+            for ix in range(-1, page.entrycount):
+                todo.append((page.getpage(ix), keys[ix + 1], keys[ix + 2], depth + 1))
+        return problems, count, pages, depths
+
+    def check_btree(self, workers=None):
+        """
+        Checks page layout, key order within and across pages, reachability of pages,
+        leaf depth and record count. Subtrees under the root page are checked by a pool
+        of forked processes, where fork is available.
+        """
+        print('checking b-tree...')
+        lastpage = self.datasize // self.pagesize
+        if not 0 < self.firstindex < lastpage:
+            print(f'root page number {self.firstindex} outside of 1..{lastpage - 1}')
+            print('b-tree check complete')
+            return 1
+        try:
+            root = self.readpage(self.firstindex)
+            problems = root.check()
+        except Exception as e:
+            problems = [f'cannot be parsed: {e}']
+        tasks = [(self.firstindex, None, None, 0)]
+        results = []
+        if problems:
+            tasks = []
+            results.append(([f'page {self.firstindex}: {p}' for p in problems], 0, [self.firstindex], set()))
+        elif root.isindex():
+            keys = [None] + [root.getkey(ix) for ix in range(root.entrycount)] + [None]
+            tasks = [(root.getpage(ix), keys[ix + 1], keys[ix + 2], 1) for ix in range(-1, root.entrycount)]
+            results.append(([], root.entrycount, [root.i], set()))
+
+        if workers != 1 and len(tasks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            global _checked_id0
+            _checked_id0 = self
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'),
+                                     initializer=_reopen_checked) as pool:
+                results.extend(pool.map(_check_subtree, tasks, chunksize=max(1, len(tasks) // 64)))
+        else:
+            results.extend(self.check_subtree(*task) for task in tasks)
+
+        errcode = 0
+        count = 0
+        seen = set()
+        depths = set()
+        for problems, n, pages, leafdepths in results:
+            for p in problems:
+                print(p)
+                errcode = 1
+            count += n
+            depths |= leafdepths
+            for nr in pages:
+                if nr in seen:
+                    print(f'page {nr} is referenced more than once')
+                    errcode = 1
+                seen.add(nr)
+        if len(depths) > 1:
+            print(f'leaf pages at different depths: {sorted(depths)}')
+            errcode = 1
+        if errcode:
+            # pages under a damaged page were not walked, so the count falls short
+            print(f'record count {self.reccount} not compared, pages have problems')
+        elif count != self.reccount:
+            print(f'record count is {self.reccount}, found {count} entries')
+            errcode = 1
+        unused = self.datasize // self.pagesize - 1 - len(seen)
+        print(f'{len(seen)} pages in tree, {unused} not in tree, {count} entries')
+        print('b-tree check complete')
+        return errcode
+
+    def query(self, spec, reverse=False):
+        """
+        Yields (key, value) of entries selected by `spec`, which is node[;tag[;start[:end]]]:
+        node is a name like '$ funcs' or a number, start and end are inclusive.
+        """
+        parts = spec.split(';')
+        if len(parts) > 3:
+            raise ValueError(f'can not parse query "{spec}"')
+        try:
+            node = auto_int(parts[0])
+        except ValueError:
+            node = self.nodeByName(parts[0])
+            if node is None:
+                raise ValueError(f'no node named "{parts[0]}"') from None
+        prefix = struct.pack('>sQ', b'.', node)
+        if len(parts) == 1:
+            return self.prefix(prefix, reverse)
+        prefix += parts[1].encode('utf-8')
+        if len(parts) == 2:
+            return self.prefix(prefix, reverse)
+        start, _, end = parts[2].partition(':')
+        start = auto_int(start)
+        end = auto_int(end) if end else start
+        return self.iterate(prefix + struct.pack('>Q', start), prefix_end(prefix + struct.pack('>Q', end)), reverse)
+
+    def functions(self):
+        """ yields start addresses of all functions in ascending order,
+        these are the 'S' entry indices of the `$ funcs` node """
+        funcsnode = self.nodeByName('$ funcs')
+        if not funcsnode:
+            raise ValueError('no function list entry')
+        prefix = makekey_name_tag(funcsnode, 'S')
+        for key, _ in self.prefix(prefix):
+            if len(key) == len(prefix) + 8:
+                yield struct.unpack_from('>Q', key, len(prefix))[0]
+
     def save(self):
         if not self.modified:
             return
         print('saving target file...')
+        if self.comp == 0 and (self.datasize > self.size or self.rewrite):
+            # uncompressed section grew by new pages, or was rebuilt
+            room = self.idb.room(0)
+            if room is not None and self.datasize > room:
+                print('moving sections...')
+                self.idb.move_following(0, self.datasize - room + self.slack)
+            self.size = self.datasize
+            self.ofh.seek(self.idb.offsets[0])
+            self.ofh.writes("BQ", self.comp, self.size)
+        self.write_header()
         for page in self.edits.values():
             print('saving page', page.i)
             page.save()  # if not compressed writes directly to file
+        crc = None
+        if self.comp == 0 and self.rewrite:
+            self.fs.seek(0)
+            self.ofh.seek(self.idb.offsets[0] + 9)
+            crc = copy_stream(self.fs, self.ofh)
         if self.comp:
             self.fs.seek(0)
             print('deflating...')
-            compressed = zlib.compress(self.fs.read())
-            expand = len(compressed) - self.size
-            if expand > 0:
+            compressed = spooled(self.mem_limit)
+            with STATS.timer('deflate'):
+                size = deflate(self.fs, compressed, self.deflate_block, self.deflate_workers)
+            room = self.idb.room(0)
+            if room is not None and size > room:
                 print('moving sections...')
-                for i in range(len(self.idb.offsets) - 1, 0, -1):
-                    self.idb.move_section(i, expand)
-                self.idb.write_head()
+                self.idb.move_following(0, size - room + self.slack)
 
-            self.size = len(compressed)
+            self.size = size
             self.ofh.seek(self.idb.offsets[0])
             self.ofh.writes("BQ", self.comp, self.size)
-            self.ofh.write(compressed)
+            compressed.seek(0)
+            crc = copy_stream(compressed, self.ofh)
+            compressed.close()
+        if crc is None:
+            # pages were written in place
+            crc = self.idb.section_crc(0)
+        self.idb.checksums[0] = crc
+        self.idb.write_head()
+
+
+# ID0 being checked by check_btree, inherited by the forked worker processes
+_checked_id0 = None
+
+def _reopen_checked():
+    _checked_id0.reopen()
+
+def _check_subtree(task):
+    return _checked_id0.check_subtree(*task)
 
 
+def copy_stream(src, dst, bufsize=0x100000):
+    """ copies until the end of `src`, returns crc32 of the data """
+    crc = 0
+    while True:
+        chunk = src.read(bufsize)
+        if not chunk:
+            break
+        dst.write(chunk)
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def writes(args):
+    """ does the command line modify the database """
+    return bool(args.rename or args.move or args.movefunc or args.insert or args.script or args.compact)
+
 def processfile(args):
     fh = FileHandler(args.target)
-    idb = IDBFile(fh)
-    id0 = ID0(idb)
+    with STATS.timer('header'):
+        idb = IDBFile(fh)
+    index_path = None
+    if not writes(args) and not args.no_index:
+        index_path = args.target + '.id0idx'
+    code = 0
+    if args.verify_crc:
+        with STATS.timer('verify_crc'):
+            code = idb.verifycrc()
+    with STATS.timer('open_id0'):
+        id0 = open_id0(args, idb, index_path)
+    code |= process(args, id0)
+    fh.close()
+    return code
+
+def open_id0(args, idb, index_path=None):
+    """ ID0 of `idb` with the cache, mapping, memory and deflate options of the command line """
+    return ID0(idb, cache_pages=args.cache_pages, cache_bytes=args.cache_bytes, use_mmap=not args.no_mmap,
+               mem_limit=args.mem_limit, index_path=index_path, deflate_block=args.deflate_block,
+               deflate_workers=args.deflate_workers, slack=args.slack)
+
+def process(args, id0):
+    """ runs the operations of a command line on an open database, returns the exit code """
+    if args.query:
+        for key, val in id0.query(args.query, args.reverse):
+            print(f'{hexdump(key)} = {hexdump(val)}')
 
     if args.show:
         id0.fdl.dirs[args.show].print()
@@ -747,8 +2288,17 @@ def processfile(args):
     if args.list:
         id0.fdl.print()
 
+    if args.orphans:
+        id0.fdl.orphans()
+
+    # every check asked for runs, and the edits after them; problems found make the exit code 1
+    code = 0
     if args.check:
-        id0.fdl.checktree()
+        with STATS.timer('check'):
+            code |= id0.fdl.checktree()
+    if args.check_btree:
+        with STATS.timer('check_btree'):
+            code |= id0.check_btree(args.check_workers)
 
     if args.rename:
         id0.fdl.rename(args.rename)
@@ -762,8 +2312,232 @@ def processfile(args):
     if args.insert:
         id0.fdl.insert(args.insert)
 
-    id0.save()
-    fh.close()
+    if args.script:
+        id0.fdl.run_script(args.script)
+
+    # only commands which loaded the folder tree can have edited it, others also
+    # work on databases without one or with folder data that can't be parsed
+    if 'fdl' in id0.__dict__:
+        with STATS.timer('apply'):
+            id0.fdl.apply()
+    if args.compact:
+        with STATS.timer('compact'):
+            id0.compact(args.compact)
+    with STATS.timer('save'):
+        id0.save()
+    return code
+
+
+# unix domain sockets are not available everywhere, --serve and --via need them
+if hasattr(socketserver, 'UnixStreamServer'):
+    class DatabaseServer(socketserver.UnixStreamServer):
+        """
+        Keeps one database open and runs command lines sent by `i64edit --via`, one at a time.
+        The database is opened again when the file changes on disk, and after a command
+        which wrote to it.
+        """
+        def __init__(self, path, args):
+            self.args = args
+            self.target = os.path.abspath(args.target)
+            self.db = None
+            self.stamp = None
+            self.stopping = False
+            super().__init__(path, DatabaseRequestHandler)
+
+        def file_stamp(self):
+            st = os.stat(self.target)
+            return st.st_ino, st.st_size, st.st_mtime_ns
+
+        def database(self):
+            stamp = self.file_stamp()
+            if self.db is not None and stamp != self.stamp:
+                print(f'{self.target} changed, reloading')
+                self.close_database()
+            if self.db is None:
+                fh = FileHandler(self.target)
+                idb = IDBFile(fh)
+                id0 = open_id0(self.args, idb)
+                try:
+                    id0.fdl
+                except ValueError:
+                    # loaded again by commands which need it, and fail there
+                    pass
+                self.db = fh, idb, id0
+                self.stamp = stamp
+            return self.db
+
+        def close_database(self):
+            if self.db is not None:
+                self.db[0].close()
+                self.db = None
+
+        def run(self, argv, cwd):
+            """ returns output and exit code of a command line, as if run in directory `cwd` """
+            out = io.StringIO()
+            code = 0
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                try:
+                    args = make_parser().parse_args(argv)
+                    if args.copyfrom or args.serve or args.stats or args.profile:
+                        raise ValueError('--copyfrom, --serve, --stats and --profile can not be sent to a server')
+                    if not os.path.samefile(os.path.join(cwd, args.target), self.target):
+                        raise ValueError(f'server has {self.target} open, not {args.target}')
+                    if args.script:
+                        args.script = os.path.join(cwd, args.script)
+                    fh, idb, id0 = self.database()
+                    if args.verify_crc:
+                        code = idb.verifycrc()
+                    code |= process(args, id0)
+                    if writes(args):
+                        self.close_database()
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else int(e.code is not None)
+                except Exception as e:
+                    if isinstance(e, ValueError):
+                        print(e)
+                    else:
+                        traceback.print_exc()
+                    code = 1
+                    # a failed edit may have left the database half modified
+                    self.close_database()
+            return out.getvalue(), code
+
+    class DatabaseRequestHandler(socketserver.StreamRequestHandler):
+        """ one json request line: argv and cwd of the client, or stop. Answers with output and exit code """
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            if request.get('stop'):
+                self.server.stopping = True
+                output, code = 'server stopped\n', 0
+            else:
+                output, code = self.server.run(request['argv'], request['cwd'])
+            self.wfile.write(json.dumps({'output': output, 'exit': code}).encode('utf-8') + b'\n')
+
+def serve(args):
+    if not hasattr(socketserver, 'UnixStreamServer'):
+        raise NotImplementedError("--serve needs unix domain sockets")
+    if os.path.exists(args.serve):
+        os.unlink(args.serve)
+    server = DatabaseServer(args.serve, args)
+    try:
+        server.database()
+        print(f'serving {server.target} on {args.serve}')
+        while not server.stopping:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close_database()
+        server.server_close()
+        os.unlink(args.serve)
+
+def query_server(path, argv, stop=False):
+    """ sends a command line to a --serve process, prints its output and exits with its exit code """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise NotImplementedError("--via needs unix domain sockets")
+    request = {'stop': True} if stop else {'argv': argv, 'cwd': os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        reply = json.loads(s.makefile('rb').readline())
+    sys.stdout.write(reply['output'])
+    sys.exit(reply['exit'])
+
+
+def batch_files(pattern):
+    """ databases under a directory, or matching a glob pattern """
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, '**', '*.i64'), recursive=True) +
+                      glob.glob(os.path.join(pattern, '**', '*.idb'), recursive=True))
+    return sorted(glob.glob(pattern, recursive=True))
+
+def _limit_memory(budget):
+    if budget:
+        # unix only, and only used in forked workers
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (budget, budget))
+
+def batch_one(args, path):
+    """ runs the command line on one database in a worker process, returns its report entry """
+    args = copy.copy(args)
+    args.target = path
+    if args.outdir:
+        args.target = os.path.join(args.outdir, os.path.relpath(path, args.batch_root))
+        os.makedirs(os.path.dirname(args.target), exist_ok=True)
+    out = io.StringIO()
+    code = 0
+    status = 'ok'
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            if args.outdir:
+                copyfile(path, args.target)
+            code = processfile(args)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except MemoryError:
+            print('out of memory')
+            code = 1
+            status = 'memory'
+        except Exception:
+            traceback.print_exc()
+            code = 1
+            status = 'error'
+    if code and status == 'ok':
+        status = 'issues'
+    return {'file': path, 'target': args.target, 'status': status, 'exit': code,
+            'seconds': round(time.perf_counter() - t0, 3), 'output': out.getvalue()}
+
+def batch(args):
+    """
+    Runs the command line on every database matching args.batch in a pool of worker
+    processes, each limited to args.mem_budget bytes of address space. Where there is
+    no fork, the files are done one after the other in this process.
+    Returns the report entries in file order.
+    """
+    files = batch_files(args.batch)
+    if not files:
+        raise ValueError(f'no databases found in {args.batch}')
+    if writes(args) and not args.outdir:
+        print('warning: edits are made in place, use --outdir to keep the originals')
+    args.no_index = True  # building an index does not pay off for a single pass over each file
+    args.batch_root = args.batch if os.path.isdir(args.batch) else os.path.dirname(args.batch.split('*')[0])
+
+    results = {}
+
+    def done(path, r):
+        results[path] = r
+        print(f'{path}: {r["status"]}, exit {r["exit"]}, {r["seconds"]}s')
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(args.jobs, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_limit_memory, initargs=(args.mem_budget,)) as pool:
+            futures = {pool.submit(batch_one, args, path): path for path in files}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    r = future.result()
+                except BrokenProcessPool:
+                    r = {'file': path, 'target': path, 'status': 'crashed', 'exit': 1, 'seconds': None, 'output': ''}
+                done(path, r)
+    else:
+        # same as check_btree without fork: one file after the other in this process
+        if args.mem_budget:
+            print('warning: --mem-budget needs fork, it is ignored')
+        for path in files:
+            done(path, batch_one(args, path))
+    return [results[path] for path in files]
+
+def write_report(filename, results):
+    """ json with the output of each run, or csv without it, chosen by file extension """
+    with open(filename, 'w', newline='') as f:
+        if filename.endswith('.csv'):
+            w = csv.writer(f)
+            w.writerow(['file', 'target', 'status', 'exit', 'seconds'])
+            for r in results:
+                w.writerow([r['file'], r['target'], r['status'], r['exit'], r['seconds']])
+        else:
+            json.dump(results, f, indent=1)
 
 
 class FuncDirList:
@@ -776,6 +2550,7 @@ class FuncDirList:
 
         # same as: idbtool.py file.i64 --query "$ dirtree/funcs;B;0"
         overview, self.ov_affected = id0.blob(self.rootnode, 'B', 0, 0xFFFF)
+        self.ov_keys = [id0.readpage(page_i).getkey(entry_i) for page_i, entry_i in self.ov_affected]
         p = IdaUnpacker(overview)
         self.first_dir = p.next32()
         self.dircount = p.next32()
@@ -786,36 +2561,78 @@ class FuncDirList:
             self.sort_info.append(p.next32())
 
         self.dirs = {}
+        dirdata = self.load_dirs()
 
         for i in range(self.dircount):
             if 0 < i < self.first_dir:
                 i = self.first_dir
+            if i in self.dirs:
+                continue
 
-            start = i * 0x10000
-            end = start + 0xFFFF
             # same as: idbtool.py file.i64 --query "$ dirtree/funcs;S;65536"
-            data, affected = id0.blob(self.rootnode, 'S', start, end)
+            data, affected, keys = dirdata.get(i, (b'', [], []))
             # print(f'funcdir {i} located at: {affected}')
             if data == b'':
                 print(f"funcdir {i} data empty")
                 continue
-            self.dirs[i] = FuncDir(id0, i, data, affected)
+            self.dirs[i] = FuncDir(id0, i, data, affected, keys)
+
+        # edits are collected here and written to the b-tree by apply()
+        self.dirty = set()
+        self.inserted = set()
+        self.ov_dirty = False
 
-        i = self.dircount
-        start = i * 0x10000
-        end = start + 0xFFFF
-        data, affected = id0.blob(self.rootnode, 'S', start, end)
-        if data != b'':
+        if any(i >= self.dircount for i in dirdata):
             print("there are extra dir entries")
 
+        self.index_tree()
+
+    def index_tree(self):
+        """ builds lookup of subdirs of each dir, parent of a dir is FuncDir.parent """
+        self.dir_children = {}
+        for i, d in self.dirs.items():
+            self.dir_children[i] = set(d.subdirs)
+
+    @cached_property
+    def func_owner(self):
+        """ the dir owning each function, made on first use as it takes memory for every function """
+        func_owner = {}
+        for i, d in self.dirs.items():
+            for ea in d.funcs:
+                func_owner.setdefault(ea, i)
+        return func_owner
+
+    def load_dirs(self):
+        """ walks all 'S' entries of the tree node once,
+        returns combined data, affected pages and keys for each dir number """
+        prefix = makekey_name_tag(self.rootnode, 'S')
+        chunks = {}
+        affected = {}
+        keys = {}
+        for cur in self.id0.scan(prefix, prefix_end(prefix)):
+            key = cur.getkey()
+            if len(key) != len(prefix) + 8:
+                continue
+            page, entry_i = cur.getpageix()
+            start, = struct.unpack_from('>Q', key, len(prefix))
+            i = start >> 16
+            chunks.setdefault(i, []).append(cur.getval())
+            affected.setdefault(i, []).append((page.i, entry_i))
+            keys.setdefault(i, []).append(key)
+        return {i: (b''.join(chunks[i]), remove_duplicates(affected[i]), keys[i]) for i in chunks}
+
 
     def print(self):
+        names = self.id0.nameof_many(ea for d in self.dirs.values() for ea in d.funcs)
+        out = []
         for d in self.dirs.values():
-            d.print()
+            out.extend(d.lines(names))
+        sys.stdout.writelines(out)
 
     def rename(self, args):
-        for d in self.dirs:
-            d.rename(args)
+        for d in self.dirs.values():
+            if d.rename(args):
+                self.dirty.add(d.i)
 
     def nameof(self, dirno):
         if dirno in self.dirs:
@@ -826,69 +2643,113 @@ class FuncDirList:
         i, newparent = args
         oldparent = self.dirs[i].parent
         self.dirs[oldparent].subdirs.remove(i)
-        self.dirs[oldparent].apply_edit()
+        self.dir_children[oldparent].discard(i)
         self.dirs[newparent].subdirs.append(i)
-        self.dirs[newparent].apply_edit()
+        self.dir_children[newparent].add(i)
         self.dirs[i].parent = newparent
-        self.dirs[i].apply_edit()
+        self.dirty.update((oldparent, newparent, i))
 
     def movefunc(self, args):
         ea, newparent = args
-        for d in self.dirs.values():
-            if ea in d.funcs:
-                oldparent = d
-                oldparent.funcs.remove(ea)
-                oldparent.apply_edit()
-                break
+        owner = self.func_owner.get(ea)
+        if owner is not None:
+            self.dirs[owner].funcs.remove(ea)
+            self.dirty.add(owner)
         self.dirs[newparent].funcs.append(ea)
-        self.dirs[newparent].apply_edit()
+        self.dirty.add(newparent)
+        self.func_owner[ea] = newparent
 
     def insert(self, args):
         i, newparent = args
         if i in self.dirs:
             raise ValueError(f"dir {i} already exists")
 
-        left_siblings = [v for k, v in self.dirs.items() if k < i]
-        if not left_siblings:
-            raise ValueError("no funcdir entries. need at least one sibling to attach to")
-        left_sibling = left_siblings[-1]
-
-        # new entry will be the next after left sibling
-        page_i, entry_i = left_sibling.affected[-1]
-        affected = [(page_i, entry_i+1)]
-
-        d = FuncDir(self.id0, i, None, affected)
+        entry_key = makekey_name_tag_start(self.rootnode, 'S', i * 0x10000)
+        d = FuncDir(self.id0, i, None, [], [entry_key])
         self.dirs[i] = d
+        self.dir_children[i] = set()
         d.name = f'newfolder_{i}'
         d.parent = newparent
-        entry_key = makekey_name_tag_start(self.rootnode, 'S', i * 0x10000)
-        d.apply_insert(entry_key)
+        self.inserted.add(i)
 
-        if i not in self.dirs[newparent].subdirs:
+        if i not in self.dir_children[newparent]:
             self.dirs[newparent].subdirs.append(i)
-            self.dirs[newparent].apply_edit()
+            self.dir_children[newparent].add(i)
+            self.dirty.add(newparent)
 
         self.dircount = len(self.dirs)
-        print("applying overview")
-        if len(self.ov_affected) > 1:
-            raise NotImplementedError("overview data spans across multiple Entries")
-        for page_i, entry_i in self.ov_affected:
-            print(f'  affected page {page_i} entry {entry_i}')
+        self.ov_dirty = True
+
+    def run_script(self, filename):
+        """
+        Applies edits listed in a file, one per line, same as command line options:
+
+            rename <from> <to>
+            move <i> <j>
+            movefunc <ea> <f>
+            insert <i> <j>
+        """
+        ops = {
+            'rename': (self.rename, str),
+            'move': (self.move, int),
+            'movefunc': (self.movefunc, auto_int),
+            'insert': (self.insert, int),
+        }
+        with open(filename) as f:
+            for lineno, line in enumerate(f, 1):
+                words = shlex.split(line, comments=True)
+                if not words:
+                    continue
+                if words[0] not in ops or len(words) != 3:
+                    raise ValueError(f'{filename}:{lineno}: can not parse "{line.strip()}"')
+                op, conv = ops[words[0]]
+                op([conv(w) for w in words[1:]])
+
+    def apply(self):
+        """ writes every changed dir and the overview into the b-tree, once each """
+        for i in sorted(self.inserted):
+            self.dirs[i].apply_insert()
+        for i in sorted(self.dirty - self.inserted):
+            self.dirs[i].apply_edit()
+
+        if self.ov_dirty:
+            print("applying overview")
+            if len(self.ov_keys) > 1:
+                raise NotImplementedError("overview data spans across multiple Entries")
             p = IdaPacker()
             p.push32(self.first_dir)
             p.push32(self.dircount)
             for s in self.sort_info:
                 p.push32(s)
-            newdata = p.data
-
-            if page_i in self.id0.edits:
-                page = self.id0.edits[page_i]
-                page.rebuild_modify(entry_i, newdata)
+            page_i, entry_i = self.id0.modify(self.ov_keys[0], p.data)
+            print(f'  affected page {page_i} entry {entry_i}')
+            self.ov_affected = [(page_i, entry_i)]
+
+        self.inserted.clear()
+        self.dirty.clear()
+        self.ov_dirty = False
+
+    def orphans(self):
+        """ merges the function list of the database with functions placed in folders,
+        reports functions in no folder and folder entries that are not functions """
+        infolders = sorted(self.func_owner)
+        orphans = []
+        j = 0
+        for ea in self.id0.functions():
+            while j < len(infolders) and infolders[j] < ea:
+                print(f'dir {self.func_owner[infolders[j]]} has {infolders[j]:X} but it is not a function')
+                j += 1
+            if j < len(infolders) and infolders[j] == ea:
+                j += 1
             else:
-                page = self.id0.readpage(page_i)
-                page.rebuild_modify(entry_i, newdata)
-                self.id0.edits[page_i] = page
+                orphans.append(ea)
+        for ea in infolders[j:]:
+            print(f'dir {self.func_owner[ea]} has {ea:X} but it is not a function')
 
+        names = self.id0.nameof_many(orphans)
+        for ea in orphans:
+            print(f'function {ea:X} {names.get(ea, "")} is not in any folder')
+        print(f'{len(orphans)} orphaned functions')
 
     def checktree(self):
         errcode = 0
@@ -900,8 +2761,7 @@ class FuncDirList:
                 print(f'dir {i} has parent {d.parent} but {d.parent} is not in tree')
                 errcode = 1
                 continue
-            subdirs = self.dirs[d.parent].subdirs
-            if i not in subdirs:
+            if i not in self.dir_children[d.parent]:
                 print(f'dir {i} has parent {d.parent} but {d.parent} has no subdir {i}')
                 errcode = 1
 
@@ -918,19 +2778,22 @@ class FuncDirList:
                     errcode = 1
 
         print('check complete')
-        sys.exit(errcode)
+        return errcode
 
 class FuncDir:
-    def __init__(self, id0: ID0, i, data, affected):
+    __slots__ = ('id0', 'i', 'affected', 'keys', 'name', 'parent', 'unk32', 'subdirs', 'funcs')
+
+    def __init__(self, id0: ID0, i, data, affected, keys):
         self.id0 = id0
         self.i = i
         self.affected = affected
+        self.keys = keys
 
         self.name = ''
         self.parent = 0
         self.unk32 = 0
-        self.subdirs = []
-        self.funcs = []
+        self.subdirs = array('Q')
+        self.funcs = array('Q')
 
         if data:
             self.parse(data)
@@ -949,33 +2812,16 @@ class FuncDir:
 
         if schema == 75:
             subdir_count = p.next32()
-            self.subdirs = []
-            while subdir_count:
-                subdir_id = p.next64signed()
-                if self.subdirs:
-                    subdir_id = self.subdirs[-1] + subdir_id
-                self.subdirs.append(subdir_id)
-                subdir_count -= 1
+            self.subdirs = p.next64signed_sums(subdir_count)
 
             func_count = p.next32()
-            self.funcs = []
-            while func_count:
-                func_id = p.next64signed()
-                if self.funcs:
-                    func_id = self.funcs[-1] + func_id
-                self.funcs.append(func_id)
-                func_count -= 1
+            self.funcs = p.next64signed_sums(func_count)
 
         elif schema == 76:
             children_count = p.next32()
             # all children are stored together, with no hint is it subdir or func
 
-            children = []
-            for i in range(children_count):
-                if not children:
-                    children.append(p.next64signed())
-                else:
-                    children.append(children[-1] + p.next64signed())
+            children = p.next64signed_sums(children_count)
 
             # interleaved counts: K sudbirs, [L funcs, [M subdirs, [N funcs, ...]]]
             subdir_count = p.next32()
@@ -986,17 +2832,16 @@ class FuncDir:
                 children_count -= childtype_count
                 childtype_counts.append(childtype_count)
 
-            self.subdirs = []
-            self.funcs = []
+            self.subdirs = array('Q')
+            self.funcs = array('Q')
             i = 0
             parsing_subdirs = True  # switch back and forth
             for childtype_count in childtype_counts:
-                for _ in range(childtype_count):
-                    if parsing_subdirs:
-                        self.subdirs.append(children[i])
-                    else:
-                        self.funcs.append(children[i])
-                    i += 1
+                if parsing_subdirs:
+                    self.subdirs.extend(children[i:i + childtype_count])
+                else:
+                    self.funcs.extend(children[i:i + childtype_count])
+                i += childtype_count
                 parsing_subdirs = not parsing_subdirs
         else:
             raise NotImplementedError('unsupported funcdir schema')
@@ -1005,23 +2850,30 @@ class FuncDir:
             raise NotImplementedError('not EOF after dir parsed')
 
     def print(self):
-        print(f"dir {self.i} = {self.name}")
-        print(f" parent = {self.parent} {self.id0.fdl.nameof(self.parent)}")
-        print(" subdirs:")
+        sys.stdout.writelines(self.lines(self.id0.nameof_many(self.funcs)))
+
+    def lines(self, names):
+        """ output lines for print, `names` maps function ea to its name """
+        fdl = self.id0.fdl
+        yield f"dir {self.i} = {self.name}\n"
+        yield f" parent = {self.parent} {fdl.nameof(self.parent)}\n"
+        yield " subdirs:\n"
         for subdir in self.subdirs:
-            print(f"  {subdir} {self.id0.fdl.nameof(subdir)}")
-        print(" functions:")
+            yield f"  {subdir} {fdl.nameof(subdir)}\n"
+        yield " functions:\n"
         for func in self.funcs:
-            print("  ", end="")
-            name = self.id0.nameof(func)
+            name = names.get(func)
             if name:
-                print(f"{func:X} {name}")
+                yield f"  {func:X} {name}\n"
+            else:
+                yield "  %x has no name\n" % func
 
     def rename(self, args):
         newname = self.name.replace(*args)
         if newname != self.name:
             self.name = newname
-            self.apply_edit()
+            return True
+        return False
 
     def pack(self):
         name = b'\x00' + self.name.encode('utf-8') + b'\x00'
@@ -1029,84 +2881,153 @@ class FuncDir:
         p.push64(self.parent)
         p.push32(self.unk32)
         p.push32(len(self.subdirs))
-
-        if len(self.subdirs):
-            baseid = self.subdirs[0]
-            p.push64(baseid)
-            for subdir in self.subdirs[1:]:
-                relative = subdir - baseid
-                baseid = subdir
-                p.push64signed(relative)
-
+        p.push64signed_deltas(self.subdirs)
         p.push32(len(self.funcs))
-
-        if len(self.funcs):
-            baseofs = self.funcs[0]
-            p.push64(baseofs)
-            for func in self.funcs[1:]:
-                relative = func - baseofs
-                baseofs = func
-                p.push64signed(relative)
+        p.push64signed_deltas(self.funcs)
 
         newdata = name + p.data
         return newdata
 
     def apply_edit(self):
         print(f'applying FuncDir {self.i}')
-        if len(self.affected) > 1:
-            raise NotImplementedError("dir data spans across multiple Entries")
-        for page_i, entry_i in self.affected:
-            print(f'  affected page {page_i} entry {entry_i}')
-            newdata = self.pack()
-            if page_i in self.id0.edits:
-                page = self.id0.edits[page_i]
-                page.rebuild_modify(entry_i, newdata)
-            else:
-                page = self.id0.readpage(page_i)
-                page.rebuild_modify(entry_i, newdata)
-                self.id0.edits[page_i] = page
-        self.id0.modified = True
+        self.store_parts(self.keys)
 
-    def apply_insert(self, entry_key):
+    def apply_insert(self):
         print(f'applying inserted FuncDir {self.i}')
-        page_i, entry_i = self.affected[0]
-        print(f'  affected page {page_i} entry {entry_i}')
-
-        entry_val = self.pack()
-        if page_i in self.id0.edits:
-            page = self.id0.edits[page_i]
-            page.rebuild_insert_entry(entry_i, entry_key, entry_val)
-        else:
-            page = self.id0.readpage(page_i)
-            page.rebuild_insert_entry(entry_i, entry_key, entry_val)
-            self.id0.edits[page_i] = page
-
-        self.id0.modified = True
+        self.store_parts([])
+
+    def store_parts(self, oldkeys):
+        """ writes the packed dir in parts like IDA does, replacing the parts at `oldkeys` """
+        data = self.pack()
+        size = blob_part_size(self.id0.pagesize)
+        prefix = makekey_name_tag(self.id0.fdl.rootnode, 'S')
+        keys = []
+        for k in range(0, len(data), size):
+            key = prefix + struct.pack('>Q', self.i * 0x10000 + k // size)
+            if key in oldkeys:
+                self.id0.modify(key, data[k:k + size])
+            else:
+                self.id0.insert(key, data[k:k + size])
+            keys.append(key)
+        for key in oldkeys:
+            if key not in keys:
+                self.id0.delete(key)
+                print(f'  removed part {hexdump(key)}')
+        # pages may have been split by a later part, so the places are looked up at the end
+        self.affected = [self.id0.locate(key) for key in keys]
+        for page_i, entry_i in self.affected:
+            print(f'  affected page {page_i} entry {entry_i}')
+        self.keys = keys
 
 
-if __name__ == "__main__":
+def make_parser():
     parser = argparse.ArgumentParser(description='Modifies funcdir tree data inside a .i64 file',
                                      formatter_class=argparse.RawDescriptionHelpFormatter, epilog="""
 Examples:
 
   i64edit target.i64 --list --check
+  i64edit target.i64 --verify-crc
+  i64edit target.i64 --check-btree
+  i64edit target.i64 --query '$ dirtree/funcs;S;0:0xFFFF'
   i64edit target.i64 --rename BadDirName GoodDirName
   i64edit target.i64 --move 12 14
   i64edit --copyfrom backup.i64 modified.i64 --insert 4 1
   i64edit --copyfrom backup.i64 modified.i64 --movefunc 0x140001070 7
+  i64edit --copyfrom backup.i64 modified.i64 --script edits.txt
+  i64edit --copyfrom backup.i64 modified.i64 --compact 0.8
+  i64edit target.i64 --check --stats stats.json --profile run.prof
+  i64edit online.i64 --serve /tmp/online.sock &
+  i64edit online.i64 --via /tmp/online.sock --check
+  i64edit --batch archive/ --check --jobs 8 --mem-budget 0x80000000 --report check.csv
 """)
     parser.add_argument("--copyfrom", metavar='filename', help='make a copy before modifying')
     parser.add_argument("target", help='IDA database to modify')
     parser.add_argument('--list', action='store_true', help='print funcdir tree')
     parser.add_argument('--show', type=int, help='print funcdir #i info', metavar='i')
     parser.add_argument('--check', action='store_true', help='check consistency (exit code 1 = have issues)')
+    parser.add_argument('--query', metavar='spec',
+                        help='print key and value of entries of a netnode: node[;tag[;start[:end]]]')
+    parser.add_argument('--reverse', action='store_true', help='with --query: print entries in descending key order')
+    parser.add_argument('--check-btree', action='store_true',
+                        help='check structure of the ID0 b-tree (exit code 1 = have issues)')
+    parser.add_argument('--check-workers', type=int, help='processes for --check-btree (default: cpu count)',
+                        metavar='n')
     parser.add_argument('--rename', nargs=2, help='string search and replace in folder names', metavar=('from', 'to'))
     parser.add_argument('--move', nargs=2, type=int, help='move folder #i to parent #j', metavar=('i', 'j'))
     parser.add_argument('--insert', nargs=2, type=int, help='create folder #i at parent #j', metavar=('i', 'j'))
-    # parser.add_argument('--orphans', action='store_true', help='find functions not attached to a folder')
+    parser.add_argument('--verify-crc', action='store_true',
+                        help='compare stored section checksums with the data (exit code 1 = mismatch)')
+    parser.add_argument('--orphans', action='store_true', help='find functions not attached to a folder')
     parser.add_argument('--movefunc', nargs=2, type=auto_int, help='move func ea to folder #f', metavar=('ea', 'f'))
-    args = parser.parse_args()
+    parser.add_argument('--script', metavar='filename',
+                        help='apply rename/move/movefunc/insert edits listed in a file, one per line')
+    parser.add_argument('--compact', nargs='?', type=float, const=0.9, metavar='fill',
+                        help='rebuild the b-tree with pages filled up to this fraction (default 0.9)')
+    parser.add_argument('--cache-pages', type=int, default=1024, help='max b-tree pages kept in memory', metavar='n')
+    parser.add_argument('--cache-bytes', type=auto_int, help='max bytes of b-tree pages kept in memory', metavar='n')
+    parser.add_argument('--no-mmap', action='store_true', help='read uncompressed ID0 with plain file reads')
+    parser.add_argument('--mem-limit', type=auto_int, default=0x10000000,
+                        help='decompressed ID0 larger than this is kept in a temporary file', metavar='bytes')
+    parser.add_argument('--no-index', action='store_true',
+                        help='do not use or create the target.i64.id0idx random access index for read-only commands')
+    parser.add_argument('--deflate-block', type=auto_int, default=0x20000,
+                        help='size of blocks compressed in parallel on save', metavar='bytes')
+    parser.add_argument('--deflate-workers', type=int, help='compression threads (default: cpu count)', metavar='n')
+    parser.add_argument('--slack', type=auto_int, default=0,
+                        help='when sections after ID0 have to be moved, leave this much extra room', metavar='bytes')
+    parser.add_argument('--debug-coverage', action='store_true',
+                        help='track which bytes of each rebuilt b-tree page are written and print them')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='filename',
+                        help='print counters and seconds per phase as json, or write them to a file')
+    parser.add_argument('--profile', metavar='filename', help='write cProfile data of the run, see pstats')
+    parser.add_argument('--serve', metavar='socket',
+                        help='keep the database open and run command lines sent with --via to this unix socket')
+    parser.add_argument('--via', metavar='socket', help='run this command line in the --serve process on the socket')
+    parser.add_argument('--stop', action='store_true', help='with --via: stop the server')
+    parser.add_argument('--batch', action='store_true',
+                        help='target is a directory or glob pattern, run the command line on every database in it')
+    parser.add_argument('--jobs', type=int, help='with --batch: worker processes (default: cpu count)', metavar='n')
+    parser.add_argument('--mem-budget', type=auto_int, metavar='bytes',
+                        help='with --batch: address space limit of each worker, mapped files and threads included')
+    parser.add_argument('--outdir', metavar='dir', help='with --batch: edit copies of the databases in this directory')
+    parser.add_argument('--report', metavar='filename', help='with --batch: write results to a .json or .csv file')
+    return parser
 
-    if args.copyfrom:
-        copyfile(args.copyfrom, args.target)
-    processfile(args)
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    TRACK_COVERAGE = args.debug_coverage
+
+    if args.via:
+        query_server(args.via, sys.argv[1:], args.stop)
+    if args.serve:
+        serve(args)
+        sys.exit(0)
+    if args.batch:
+        args.batch = args.target
+        results = batch(args)
+        if args.report:
+            write_report(args.report, results)
+        counts = {}
+        for r in results:
+            counts[r['status']] = counts.get(r['status'], 0) + 1
+        print(f'{len(results)} files: ' + ', '.join(f'{n} {status}' for status, n in sorted(counts.items())))
+        sys.exit(int(any(r['exit'] for r in results)))
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with STATS.timer('total'):
+            if args.copyfrom:
+                with STATS.timer('copy'):
+                    copyfile(args.copyfrom, args.target)
+            code = processfile(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats:
+            STATS.write(args.stats)
+    sys.exit(code)
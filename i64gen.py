@@ -0,0 +1,236 @@
+"""
+Writes synthetic .i64 files with a function folder tree, for benchmarks and for
+trying out i64edit.py on databases that can be shared.
+
+The ID0 b-tree holds what i64edit.py reads: function names, the `$ funcs` list and
+the `$ dirtree/funcs` tree in schema 75 or 76, optionally padded with filler
+entries to reach a number of pages. The other sections hold placeholder data.
+"""
+import argparse
+import io
+import random
+import struct
+import tempfile
+
+from i64edit import BTreeLoader, IDBFile, IdaPacker, auto_int, blob_part_size, copy_stream, deflate, \
+    makekey_name_tag, makekey_name_tag_start
+
+DIRTREE_NODE = 0xFF000000000000DA
+FUNCS_NODE = 0xFF000000000000E0
+FILLER_NODE = 0xFF00000000000100
+
+CORRUPTIONS = {
+    'missing-dir': 'the last dir is referenced by its parent but has no data',
+    'bad-parent': 'the last dir names a parent that does not list it as subdir',
+    'orphan': 'one function is in no folder',
+    'crc': 'the stored ID0 checksum is wrong',
+    'reccount': 'the b-tree header record count is one too high',
+    'order': 'the first two entries of the first leaf page are swapped',
+    'npage': 'an entry of the root page points to the preceding child page again',
+}
+
+
+def make_tree(ndirs, nfuncs, base=0x140001000, seed=1):
+    """
+    Random folder tree: dir 0 is the root, every other dir gets a random parent
+    among the dirs before it. Returns dict of dir number -> [parent, subdirs, funcs]
+    and the list of function addresses.
+    """
+    rnd = random.Random(seed)
+    eas = []
+    ea = base
+    for _ in range(nfuncs):
+        eas.append(ea)
+        ea += rnd.choice((0x10, 0x20, 0x40, 0x100, 0x1000))
+    dirs = {0: [0, [], []]}
+    for i in range(1, ndirs):
+        parent = rnd.randrange(i)
+        dirs[i] = [parent, [], []]
+        dirs[parent][1].append(i)
+    for ea in eas:
+        dirs[rnd.randrange(ndirs)][2].append(ea)
+    return dirs, eas
+
+
+def pack_dir(name, parent, subdirs, funcs, schema=75):
+    """ dir blob as stored in the 'S' entries of the tree node """
+    p = IdaPacker()
+    p.push64(parent)
+    p.push32(0)
+    if schema == 75:
+        p.push32(len(subdirs))
+        p.push64signed_deltas(subdirs)
+        p.push32(len(funcs))
+        p.push64signed_deltas(funcs)
+    elif schema == 76:
+        p.push32(len(subdirs) + len(funcs))
+        p.push64signed_deltas(subdirs + funcs)
+        p.push32(len(subdirs))
+        if funcs:
+            p.push32(len(funcs))
+    else:
+        raise NotImplementedError('unsupported funcdir schema')
+    return bytes([schema - 75]) + name.encode('utf-8') + b'\0' + p.data
+
+
+def entries(dirs, eas, schema=75, chunk=0x400, corrupt=(), filler=None):
+    """
+    Yields all ID0 entries in key order. Dir blobs are split in `chunk` byte parts
+    like IDA does, which must leave room for a few of them in a page. `filler(count)`
+    is called before the filler entries, with the number added so far, and returns
+    False to stop.
+    """
+    orphan = eas[len(eas) // 2] if 'orphan' in corrupt and eas else None
+    last = max(dirs)
+
+    for ea in eas:
+        yield makekey_name_tag(ea, 'N'), f'sub_{ea:X}'.encode('utf-8') + b'\0'
+
+    ov = IdaPacker()
+    ov.push32(1)
+    ov.push32(len(dirs))
+    yield makekey_name_tag_start(DIRTREE_NODE, 'B', 0), bytes(ov.data)
+    for i, (parent, subdirs, funcs) in sorted(dirs.items()):
+        if i == last and i and 'missing-dir' in corrupt:
+            continue
+        if i == last and i and 'bad-parent' in corrupt:
+            parent = 0 if parent else 1
+        funcs = [ea for ea in funcs if ea != orphan]
+        blob = pack_dir(f'dir{i}', parent, subdirs, funcs, schema)
+        for k in range(0, len(blob), chunk):
+            yield makekey_name_tag_start(DIRTREE_NODE, 'S', i * 0x10000 + k // chunk), blob[k:k + chunk]
+
+    for ea in eas:
+        yield makekey_name_tag_start(FUNCS_NODE, 'S', ea), struct.pack('<QL', ea, 0)
+
+    if filler:
+        rnd = random.Random(len(eas))
+        n = 0
+        while filler(n):
+            yield makekey_name_tag_start(FILLER_NODE, 'S', n), rnd.randbytes(rnd.randrange(8, 64))
+            n += 1
+
+    yield b'N$ dirtree/funcs', struct.pack('<Q', DIRTREE_NODE)
+    yield b'N$ funcs', struct.pack('<Q', FUNCS_NODE)
+
+
+def corrupt_btree(fs, pagesize, root, corrupt):
+    """ damages pages of the b-tree written to `fs` """
+    def readpage(nr):
+        fs.seek(nr * pagesize)
+        return bytearray(fs.read(pagesize))
+
+    def writepage(nr, data):
+        fs.seek(nr * pagesize)
+        fs.write(data)
+
+    if 'order' in corrupt:
+        # page 1 is the first leaf written by BTreeLoader
+        page = readpage(1)
+        count, = struct.unpack_from('<H', page, 4)
+        if count >= 2:
+            a, = struct.unpack_from('<H', page, 10)
+            b, = struct.unpack_from('<H', page, 16)
+            struct.pack_into('<H', page, 10, b)
+            struct.pack_into('<H', page, 16, a)
+            writepage(1, page)
+    if 'npage' in corrupt:
+        page = readpage(root)
+        preceding, count = struct.unpack_from('<LH', page, 0)
+        if preceding and count:
+            struct.pack_into('<L', page, 6 + 6 * (count // 2), preceding)
+            writepage(root, page)
+
+
+def build_id0(out, loader, items, corrupt=()):
+    """ writes the b-tree to the file of `loader`, page 0 holds the header """
+    for key, val in items:
+        loader.add(key, val)
+    root = loader.finish()
+    corrupt_btree(out, loader.pagesize, root, corrupt)
+
+    reccount = loader.count + ('reccount' in corrupt)
+    out.seek(0)
+    out.write(struct.pack('=LHLLL', 0, loader.pagesize, root, reccount, loader.npages + 1) + b'\0B-tree v2')
+    return root
+
+
+def write_section(f, data, compress):
+    """ writes section header and everything in file `data`, returns crc32 of the stored data """
+    data.seek(0)
+    if compress:
+        packed = tempfile.TemporaryFile()
+        deflate(data, packed)
+        data = packed
+    size = data.seek(0, 2)
+    data.seek(0)
+    f.write(struct.pack('=BQ', 2 if compress else 0, size))
+    return copy_stream(data, f)
+
+
+def generate(path, ndirs=10, nfuncs=100, schema=75, compress=False, pagesize=0x2000, fill=0.9, pages=0,
+             corrupt=(), magic='IDA2', seed=1):
+    """ writes a synthetic database to `path`, returns the number of b-tree pages and entries """
+    for c in corrupt:
+        if c not in CORRUPTIONS:
+            raise ValueError(f'unknown corruption {c}')
+    if ndirs < 1:
+        raise ValueError('need at least the root dir')
+    dirs, eas = make_tree(ndirs, nfuncs, seed=seed)
+
+    with tempfile.TemporaryFile() as id0:
+        loader = BTreeLoader(id0, pagesize, fill)
+        # filler entries sort after all others under a '.' key, so only the
+        # 'N' entries are left to add once the page count is reached
+        filler = (lambda n: loader.npages + 1 < pages) if pages else None
+        items = entries(dirs, eas, schema, blob_part_size(pagesize), corrupt, filler)
+        build_id0(id0, loader, items, corrupt)
+
+        with open(path, 'wb') as f:
+            f.write(magic.encode('ascii').ljust(6, b'\0'))
+            f.write(bytes(struct.calcsize('=QQLLHQQQ5LQL')))
+            offsets = []
+            crcs = []
+            for i, name in enumerate(IDBFile.SECTIONS):
+                offsets.append(f.tell())
+                data = id0 if i == 0 else io.BytesIO(name.encode('ascii') * 64)
+                crcs.append(write_section(f, data, compress))
+            if 'crc' in corrupt:
+                crcs[0] ^= 0xFFFFFFFF
+            f.seek(6)
+            f.write(struct.pack('=QQLLHQQQ5LQL', offsets[0], offsets[1], 0, 0, 6, offsets[2], offsets[3], offsets[4],
+                                *crcs[:5], offsets[5], crcs[5]))
+    return loader.npages + 1, loader.count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Writes a synthetic .i64 file with a function folder tree',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog="""
+Examples:
+
+  i64gen small.i64 --dirs 10 --funcs 200
+  i64gen big.i64 --dirs 3000 --funcs 300000 --compress
+  i64gen padded.i64 --funcs 1000 --pages 20000
+  i64gen bad.i64 --schema 76 --corrupt missing-dir --corrupt orphan
+
+Corruptions:
+
+""" + '\n'.join(f'  {k:12} {v}' for k, v in CORRUPTIONS.items()))
+    parser.add_argument("target", help='file to write')
+    parser.add_argument('--dirs', type=int, default=10, help='number of folders, including the root', metavar='n')
+    parser.add_argument('--funcs', type=int, default=100, help='number of functions', metavar='n')
+    parser.add_argument('--schema', type=int, choices=(75, 76), default=75, help='folder data layout')
+    parser.add_argument('--compress', action='store_true', help='zlib compressed sections')
+    parser.add_argument('--pagesize', type=auto_int, default=0x2000, help='b-tree page size', metavar='bytes')
+    parser.add_argument('--fill', type=float, default=0.9, help='fraction of each page filled', metavar='f')
+    parser.add_argument('--pages', type=int, default=0, help='add filler entries until the b-tree has this many pages',
+                        metavar='n')
+    parser.add_argument('--corrupt', action='append', default=[], choices=sorted(CORRUPTIONS),
+                        help='damage the file, can be given more than once')
+    parser.add_argument('--magic', choices=('IDA1', 'IDA2'), default='IDA2', help='file signature')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the folder tree')
+    args = parser.parse_args()
+
+    npages, count = generate(args.target, args.dirs, args.funcs, args.schema, args.compress, args.pagesize, args.fill,
+                             args.pages, args.corrupt, args.magic, args.seed)
+    print(f'{args.target}: {args.dirs} dirs, {args.funcs} funcs, {npages} pages, {count} entries')
@@ -0,0 +1,253 @@
+"""
+Runs i64edit.py on databases written by i64gen.py: python -m pytest test_i64edit.py
+"""
+import contextlib
+import io
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import i64edit
+from i64edit import ID0, Cursor, FileHandler, IDBFile, IdaPacker, IdaUnpacker, pack_deltas, unpack_deltas
+from i64gen import generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(*argv):
+    """ runs i64edit.py with `argv`, returns exit code and output """
+    p = subprocess.run([sys.executable, os.path.join(HERE, 'i64edit.py'), *map(str, argv)],
+                       capture_output=True, text=True)
+    return p.returncode, p.stdout + p.stderr
+
+
+def check_clean(path):
+    for opt in ('--check-btree', '--verify-crc', '--check'):
+        code, out = run(path, opt, '--no-index')
+        assert code == 0, out
+
+
+def open_id0(path):
+    fh = FileHandler(str(path))
+    return fh, ID0(IDBFile(fh))
+
+
+def quietly(fn, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_edits_splits_and_compact(tmp_path, compress):
+    path = tmp_path / 'edit.i64'
+    generate(str(path), 20, 3000, compress=compress, pagesize=0x800)
+    check_clean(path)
+
+    fh, id0 = open_id0(path)
+    fdl = id0.fdl
+    moved = [ea for i, d in sorted(fdl.dirs.items()) if i != 3 for ea in d.funcs][:1500]
+    fh.close()
+    script = tmp_path / 'edits.txt'
+    script.write_text(''.join(f'movefunc {ea:#x} 3\n' for ea in moved) + 'insert 20 3\nrename dir1 first\n')
+    code, out = run(path, '--script', script)
+    assert code == 0, out
+    # dir 3 grew over many 1 KiB parts, which made pages split
+    assert 'split page' in out
+    check_clean(path)
+
+    fh, id0 = open_id0(path)
+    d = id0.fdl.dirs[3]
+    assert len(d.keys) > 4
+    assert set(moved) <= set(d.funcs)
+    assert 20 in d.subdirs and id0.fdl.dirs[20].parent == 3
+    assert id0.fdl.dirs[1].name == 'first'
+    fh.close()
+
+    # moving them out again leaves parts over, which are deleted
+    script.write_text(''.join(f'movefunc {ea:#x} 0\n' for ea in moved))
+    code, out = run(path, '--script', script)
+    assert code == 0, out
+    assert 'removed part' in out
+    check_clean(path)
+
+    code, before = run(path, '--list')
+    assert code == 0, before
+    code, out = run(path, '--compact', '0.7')
+    assert code == 0, out
+    check_clean(path)
+    code, after = run(path, '--list')
+    assert after == before
+
+
+def test_generated_small_pages(tmp_path):
+    path = tmp_path / 'small.i64'
+    generate(str(path), 50, 20000, pagesize=0x400)
+    check_clean(path)
+    code, out = run(path, '--movefunc', 0x140001000, 7)
+    assert code == 0, out
+    check_clean(path)
+
+
+@pytest.mark.parametrize('corrupt, option', [
+    ('missing-dir', '--check'),
+    ('bad-parent', '--check'),
+    ('crc', '--verify-crc'),
+    ('reccount', '--check-btree'),
+    ('order', '--check-btree'),
+])
+def test_corruptions_found(tmp_path, corrupt, option):
+    path = tmp_path / 'bad.i64'
+    generate(str(path), 50, 5000, corrupt=[corrupt])
+    code, out = run(path, option)
+    assert code == 1, out
+
+
+def test_all_checks_run(tmp_path):
+    path = tmp_path / 'bad.i64'
+    generate(str(path), 50, 5000, corrupt=['order'])
+    code, out = run(path, '--check', '--check-btree', '--no-index')
+    assert code == 1, out
+    lines = out.splitlines()
+    assert 'check complete' in lines and 'b-tree check complete' in lines
+
+
+def test_crc_mismatch_keeps_other_options(tmp_path):
+    path = tmp_path / 'crc.i64'
+    generate(str(path), 20, 2000, corrupt=['crc'])
+    code, out = run(path, '--verify-crc', '--check', '--insert', 20, 3)
+    assert code == 1, out
+    assert 'MISMATCH' in out and 'check complete' in out.splitlines()
+    fh, id0 = open_id0(path)
+    assert id0.fdl.dirs[20].parent == 3
+    fh.close()
+
+
+def test_batch_checks_and_edits(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    generate(str(src / 'good.i64'), 20, 2000)
+    generate(str(src / 'bad.i64'), 20, 2000, corrupt=['bad-parent'])
+    script = tmp_path / 'edits.txt'
+    script.write_text('insert 20 3\n')
+    out = tmp_path / 'out'
+    code, text = run('--batch', src, '--check', '--script', script, '--outdir', out)
+    assert code == 1, text
+    assert 'good.i64: ok' in text and 'bad.i64: issues' in text
+    for name in ('good.i64', 'bad.i64'):
+        fh, id0 = open_id0(out / name)
+        assert id0.fdl.dirs[20].parent == 3
+        fh.close()
+
+
+def test_bad_root_reported(tmp_path):
+    path = tmp_path / 'root.i64'
+    generate(str(path), 30, 5000, pagesize=0x800)
+    fh, id0 = open_id0(path)
+    id0.editpage(id0.firstindex).entrycount = 5000
+    assert quietly(id0.check_btree, 1) == 1
+    id0.edits.clear()
+    id0.firstindex = id0.datasize // id0.pagesize
+    assert quietly(id0.check_btree, 1) == 1
+    fh.close()
+
+
+@pytest.mark.parametrize('numpy_min', [1, 1 << 30])
+def test_bulk_varint_codec(monkeypatch, numpy_min):
+    monkeypatch.setattr(i64edit, 'NUMPY_MIN_VALUES', numpy_min)
+    rnd = random.Random(numpy_min)
+    lists = [
+        [],
+        sorted(rnd.randrange(0x140000000, 0x150000000) for _ in range(3000)),
+        [rnd.choice((0, 1, 0x7F, 0x80, 0x3FFF, 0x4000, 0x1FFFFFFF, 0x20000000, 0xFFFFFFFF, 1 << 32,
+                     (1 << 64) - 1)) for _ in range(3000)],
+        [rnd.getrandbits(64) for _ in range(500)],
+    ]
+    for values in lists:
+        p = IdaPacker()
+        prev = 0
+        for val in values:
+            p.push64signed((val - prev + (1 << 63)) % (1 << 64) - (1 << 63))
+            prev = val
+        assert pack_deltas(values) == bytes(p.data)
+
+        data = bytes(p.data) + b'\x05'
+        u = IdaUnpacker(data)
+        expected = []
+        total = 0
+        for _ in values:
+            total = (total + u.next64signed()) % (1 << 64)
+            expected.append(total)
+        got, end = unpack_deltas(data, 0, len(values))
+        assert got.tolist() == expected
+        assert end == u.o
+
+
+def test_truncated_varints_rejected():
+    data = pack_deltas(list(range(0, 0x10000000, 0x1000)))
+    with pytest.raises(ValueError):
+        unpack_deltas(data[:-1], 0, 0x10000)
+
+
+def test_seek_matches_descent(tmp_path):
+    path = tmp_path / 'seek.i64'
+    generate(str(path), 30, 5000, pagesize=0x800)
+    fh, id0 = open_id0(path)
+    keys = [bytes(k) for k, _ in id0.iterate()]
+    rnd = random.Random(1)
+    probes = sorted(rnd.sample(keys, 800) + [k + b'\0' for k in rnd.sample(keys, 200)] + [b'', b'\xff' * 20])
+    for request in ('eq', 'lt', 'le', 'gt', 'ge'):
+        cur = Cursor(id0, [])
+        for key in probes:
+            fresh = id0.find(request, key)
+            moved = id0.find(request, key, cur)
+            if fresh is None or fresh.eof():
+                assert moved is None or moved.eof()
+                cur = Cursor(id0, [])
+                continue
+            assert moved.getkey() == fresh.getkey()
+            assert [(page.i, ix) for page, ix in moved.stack] == [(page.i, ix) for page, ix in fresh.stack]
+            cur = moved
+    fh.close()
+
+
+def test_reverse_iteration(tmp_path):
+    path = tmp_path / 'rev.i64'
+    generate(str(path), 30, 5000, pagesize=0x800)
+    fh, id0 = open_id0(path)
+    keys = [bytes(k) for k, _ in id0.iterate()]
+    assert [bytes(k) for k, _ in id0.iterate(reverse=True)] == keys[::-1]
+    rnd = random.Random(2)
+    for _ in range(20):
+        start, stop = sorted(rnd.sample(keys, 2))
+        assert [bytes(k) for k, _ in id0.iterate(start, stop, reverse=True)] == \
+            [k for k in keys if start <= k < stop][::-1]
+    fh.close()
+
+
+def test_insert_delete(tmp_path):
+    path = tmp_path / 'del.i64'
+    generate(str(path), 5, 1500, pagesize=0x800)
+    rnd = random.Random(3)
+    fh, id0 = open_id0(path)
+    model = {bytes(k): bytes(v) for k, v in id0.iterate()}
+    for _ in range(4000):
+        if rnd.random() < 0.7:
+            key = rnd.choice(list(model))
+            quietly(id0.delete, key)
+            del model[key]
+        else:
+            key = b'.' + rnd.randbytes(rnd.randrange(4, 20))
+            val = rnd.randbytes(rnd.randrange(300))
+            quietly(id0.modify if key in model else id0.insert, key, val)
+            model[key] = val
+    assert {bytes(k): bytes(v) for k, v in id0.iterate()} == model
+    quietly(id0.save)
+    fh.close()
+
+    fh, id0 = open_id0(path)
+    assert {bytes(k): bytes(v) for k, v in id0.iterate()} == model
+    assert quietly(id0.check_btree, 1) == 0
+    fh.close()